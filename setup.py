@@ -27,6 +27,7 @@ setup(
     install_requires=[
         'setuptools',
         'Flask',
+        'numpy',
     ],
     entry_points="""
     [console_scripts]
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer.
+
+Views are imported by presence_analyzer.script.configure_app, so the
+package itself loads only Flask.
 """
 from .main import app
-from . import views
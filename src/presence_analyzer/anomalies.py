@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of irregular presence patterns.
+"""
+import calendar
+import json
+from datetime import datetime
+
+import numpy
+
+from presence_analyzer.utils import presence_columns
+
+
+def short_days(columns, min_day_hours):
+    """
+    Days shorter than min_day_hours.
+    """
+    hours = (columns['ends'] - columns['starts']) / 3600.0
+    rows = numpy.flatnonzero(hours < min_day_hours)
+    return [
+        {
+            'rule': 'short_day',
+            'user_id': int(columns['users'][row]),
+            'date': datetime.fromordinal(columns['dates'][row]).date(),
+            'hours': round(hours[row], 2),
+        }
+        for row in rows
+    ]
+
+
+def arrival_shifts(columns, max_arrival_shift_hours):
+    """
+    Arrivals differing from previous presence day by more than
+    max_arrival_shift_hours.
+    """
+    users = columns['users']
+    shift = numpy.zeros(len(users))
+    shift[1:] = numpy.abs(numpy.diff(columns['starts'])) / 3600.0
+    shift[1:][users[1:] != users[:-1]] = 0
+    rows = numpy.flatnonzero(shift > max_arrival_shift_hours)
+    return [
+        {
+            'rule': 'arrival_shift',
+            'user_id': int(users[row]),
+            'date': datetime.fromordinal(columns['dates'][row]).date(),
+            'shift_hours': round(shift[row], 2),
+        }
+        for row in rows
+    ]
+
+
+def missing_weekdays(columns, min_weekday_share, min_weeks):
+    """
+    Working weekdays with less than min_weekday_share of user's typical
+    presence count, for users with at least min_weeks of data.
+    """
+    if not len(columns['users']):
+        return []
+    users, first, index = numpy.unique(
+        columns['users'], return_index=True, return_inverse=True
+    )
+    weekdays = (columns['dates'] - 1) % 7
+    counts = numpy.bincount(
+        index * 7 + weekdays, minlength=len(users) * 7
+    ).reshape(-1, 7)[:, :5]
+    last = numpy.append(first[1:], len(index)) - 1
+    weeks = (columns['dates'][last] - columns['dates'][first]) // 7 + 1
+    typical = counts.mean(axis=1)
+    missing = (
+        (counts < min_weekday_share * typical[:, None]) &
+        (weeks >= min_weeks)[:, None]
+    )
+    return [
+        {
+            'rule': 'missing_weekday',
+            'user_id': int(users[user]),
+            'weekday': calendar.day_abbr[weekday],
+            'days': int(counts[user, weekday]),
+            'typical': round(typical[user], 2),
+        }
+        for user, weekday in zip(*numpy.nonzero(missing))
+    ]
+
+
+def find_anomalies(
+        columns,
+        min_day_hours=4.0,
+        max_arrival_shift_hours=3.0,
+        min_weekday_share=0.5,
+        min_weeks=4):
+    """
+    Flags irregular presence patterns in presence columns.
+    """
+    return (
+        short_days(columns, min_day_hours) +
+        arrival_shifts(columns, max_arrival_shift_hours) +
+        missing_weekdays(columns, min_weekday_share, min_weeks)
+    )
+
+
+def write_report(path, **rules):
+    """
+    Writes JSON report of anomalies in presence data, returns their count.
+    """
+    anomalies = find_anomalies(presence_columns(), **rules)
+    for anomaly in anomalies:
+        if 'date' in anomaly:
+            anomaly['date'] = anomaly['date'].isoformat()
+    with open(path, 'w') as report:
+        json.dump(
+            {
+                'generated': datetime.now().isoformat(),
+                'rules': rules,
+                'anomalies': anomalies,
+            },
+            report,
+            indent=2,
+            sort_keys=True
+        )
+    return len(anomalies)
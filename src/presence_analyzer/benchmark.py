@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of presence data loading from plain and compressed files.
+"""
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from presence_analyzer.utils import (
+    compression,
+    data_files,
+    load_shards,
+    lzma_module,
+    open_compressed,
+    shard_cache
+)
+
+
+def read_data(path):
+    """
+    Decompressed content of all CSV files behind DATA_CSV like path.
+    """
+    content = []
+    for name in data_files(path):
+        kind = compression(name)
+        if kind:
+            csvfile = open_compressed(name, kind)
+        else:
+            csvfile = open(name, 'rb')
+        with csvfile:
+            content.append(csvfile.read())
+    return ''.join(content)
+
+
+def write_copies(content, directory):
+    """
+    Writes content as plain, gzip, bz2 and, when lzma is importable,
+    xz compressed CSV files. Returns kind -> path mapping.
+    """
+    openers = [
+        ('plain', '', open),
+        ('gzip', '.gz', gzip.open),
+        ('bz2', '.bz2', bz2.BZ2File),
+    ]
+    lzma = lzma_module()
+    if lzma is not None:
+        openers.append(('xz', '.xz', lzma.LZMAFile))
+    copies = {}
+    for kind, extension, opener in openers:
+        path = os.path.join(directory, 'presence.csv' + extension)
+        with opener(path, 'wb') as csvfile:
+            csvfile.write(content)
+        copies[kind] = path
+    return copies
+
+
+def ingest_benchmark(path, repeat=3):
+    """
+    Best end-to-end load time of the same data stored plain and
+    compressed. Returns kind, size on disk, rows and seconds of every
+    file, plain file first.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        copies = write_copies(read_data(path), directory)
+        results = []
+        for kind in sorted(copies, key=lambda kind: kind != 'plain'):
+            timings = []
+            for _ in xrange(repeat):
+                shard_cache.pop(copies[kind], None)
+                start = time.time()
+                shard = load_shards([copies[kind]])[0]
+                timings.append(time.time() - start)
+            shard_cache.pop(copies[kind], None)
+            results.append({
+                'kind': kind,
+                'size': os.path.getsize(copies[kind]),
+                'rows': sum(len(dates) for dates in shard.itervalues()),
+                'seconds': min(timings),
+            })
+        return results
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backends keeping pickled values in process, in local files
+or on memcached servers shared by several nodes.
+
+Every backend provides get(key, default), set(key, value, timeout)
+and delete(key); timeout is in seconds and 0 keeps value until evicted.
+Failures of shared backends are logged and read as cache misses.
+"""
+import cPickle
+import errno
+import glob
+import hashlib
+import logging
+import math
+import os
+import socket
+import SocketServer
+import threading
+import time
+import zlib
+
+from presence_analyzer.helpers import write_file
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def key_digest(key):
+    """
+    Hex digest of hashable key, safe as file name and memcached key.
+    """
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+class CacheBackend(object):
+    """
+    Base of cache backends, keeping nothing. Shared backends keep
+    values outside of this process.
+    """
+    shared = False
+
+    def get(self, key, default=None):  # pylint: disable=unused-argument
+        """
+        Returns value of key or default when missing or expired.
+        """
+        return default
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value of key.
+        """
+        pass
+
+    def delete(self, key):
+        """
+        Removes key.
+        """
+        pass
+
+    def prune(self, max_age):
+        """
+        Removes values stored more than max_age seconds ago, when backend
+        does not evict them itself.
+        """
+        pass
+
+
+class DictBackend(CacheBackend):
+    """
+    Values in dict of this process.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = {} if storage is None else storage
+
+    def get(self, key, default=None):
+        """
+        Returns value of key or default when missing or expired.
+        """
+        try:
+            expires, value = self.storage[key]
+        except KeyError:
+            return default
+        if expires and expires < time.time():
+            self.storage.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value of key.
+        """
+        self.storage[key] = (time.time() + timeout if timeout else 0, value)
+
+    def delete(self, key):
+        """
+        Removes key.
+        """
+        self.storage.pop(key, None)
+
+
+class FileBackend(CacheBackend):
+    """
+    Values in files of local directory, surviving restarts.
+    """
+    shared = True
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        """
+        File holding value of key.
+        """
+        digest = key_digest(key)
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key, default=None):
+        """
+        Returns value of key or default when missing or expired.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                expires, value = cPickle.load(entry)
+        except IOError:
+            return default
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            log.warning('Cannot read cache entry %s', path, exc_info=True)
+            return default
+        if expires and expires < time.time():
+            self.delete(key)
+            return default
+        return value
+
+    def set(self, key, value, timeout=0):
+        """
+        Writes value of key atomically.
+        """
+        path = self.path(key)
+        expires = time.time() + timeout if timeout else 0
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            write_file(
+                path, cPickle.dumps((expires, value), cPickle.HIGHEST_PROTOCOL)
+            )
+        except (IOError, OSError, TypeError, cPickle.PicklingError):
+            log.warning('Cannot write cache entry %s', path, exc_info=True)
+
+    def delete(self, key):
+        """
+        Removes file of key.
+        """
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def prune(self, max_age):
+        """
+        Removes files written more than max_age seconds ago.
+        """
+        deadline = time.time() - max_age
+        for path in glob.glob(os.path.join(self.directory, '*', '*')):
+            try:
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class MemcachedBackend(CacheBackend):
+    """
+    Values on memcached servers given as 'host:port', spoken to
+    with the text protocol. Keys are spread over servers by hash.
+    """
+    shared = True
+
+    def __init__(self, servers, timeout=1.0, prefix='presence_analyzer'):
+        self.servers = []
+        for server in servers:
+            host, _, port = server.rpartition(':')
+            self.servers.append((host, int(port)))
+        self.timeout = timeout
+        self.prefix = prefix
+        self.local = threading.local()
+
+    def connect(self, name):
+        """
+        Returns (server, socket file) of key name, one per thread.
+        """
+        server = self.servers[zlib.crc32(name) % len(self.servers)]
+        connections = self.local.__dict__.setdefault('connections', {})
+        if server not in connections:
+            connection = socket.create_connection(server, self.timeout)
+            connections[server] = connection.makefile('rwb')
+            connection.close()
+        return server, connections[server]
+
+    def command(self, key, line, payload=None):
+        """
+        Sends command about key and returns its reply lines up to
+        the final one, with value payload after VALUE lines.
+        """
+        name = '{}:{}'.format(self.prefix, key_digest(key))
+        server = None
+        try:
+            server, stream = self.connect(name)
+            stream.write(line.format(name) + '\r\n')
+            if payload is not None:
+                stream.write(payload + '\r\n')
+            stream.flush()
+            reply = []
+            while True:
+                response = stream.readline()
+                if not response:
+                    raise socket.error('Connection closed by memcached')
+                reply.append(response.rstrip('\r\n'))
+                if response.startswith('VALUE '):
+                    size = int(response.split()[3])
+                    reply.append(stream.read(size + 2)[:size])
+                elif not line.startswith('get') or response.startswith('END'):
+                    return reply
+        except (socket.error, ValueError, IndexError):
+            log.warning('Memcached %s failed', server, exc_info=True)
+            connections = self.local.__dict__.get('connections', {})
+            stream = connections.pop(server, None)
+            if stream is not None:
+                stream.close()
+            return []
+
+    def get(self, key, default=None):
+        """
+        Returns value of key or default when missing.
+        """
+        reply = self.command(key, 'get {}')
+        if len(reply) < 2 or not reply[0].startswith('VALUE '):
+            return default
+        try:
+            return cPickle.loads(reply[1])
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            log.warning('Cannot read memcached value', exc_info=True)
+            return default
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value of key on its server.
+        """
+        try:
+            payload = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except (TypeError, cPickle.PicklingError):
+            log.warning('Cannot pickle value for memcached', exc_info=True)
+            return
+        reply = self.command(
+            key,
+            'set {{}} 0 {} {}'.format(int(math.ceil(timeout)), len(payload)),
+            payload
+        )
+        if reply and reply[0] != 'STORED':
+            log.warning('Memcached did not store value: %s', reply[0])
+
+    def delete(self, key):
+        """
+        Removes key from its server.
+        """
+        self.command(key, 'delete {}')
+
+
+class MemcachedStandInHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves get, set, delete, flush_all and version commands.
+    """
+
+    def setup(self):
+        """
+        Registers connection, so stop can close it.
+        """
+        SocketServer.StreamRequestHandler.setup(self)
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        """
+        Forgets closed connection.
+        """
+        self.server.connections.discard(self.connection)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        """
+        Answers commands until client disconnects.
+        """
+        storage = self.server.storage
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            words = line.split()
+            if not words:
+                continue
+            command = words[0]
+            if command == 'get':
+                for name in words[1:]:
+                    item = storage.get(name)
+                    if item and (not item[0] or item[0] >= time.time()):
+                        self.wfile.write(
+                            'VALUE {} 0 {}\r\n{}\r\n'.format(
+                                name, len(item[1]), item[1]
+                            )
+                        )
+                self.wfile.write('END\r\n')
+            elif command == 'set':
+                name, _, exptime, size = words[1:5]
+                value = self.rfile.read(int(size) + 2)[:int(size)]
+                expires = time.time() + int(exptime) if int(exptime) else 0
+                storage[name] = (expires, value)
+                self.wfile.write('STORED\r\n')
+            elif command == 'delete':
+                found = storage.pop(words[1], None) is not None
+                self.wfile.write('DELETED\r\n' if found else 'NOT_FOUND\r\n')
+            elif command == 'flush_all':
+                storage.clear()
+                self.wfile.write('OK\r\n')
+            elif command == 'version':
+                self.wfile.write('VERSION stand-in\r\n')
+            else:
+                self.wfile.write('ERROR\r\n')
+            self.wfile.flush()
+
+
+class MemcachedStandIn(SocketServer.ThreadingTCPServer):
+    """
+    In-process server speaking enough memcached text protocol for
+    MemcachedBackend, so tests need no memcached service.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, (host, port), MemcachedStandInHandler
+        )
+        self.storage = {}
+        self.connections = set()
+        self.thread = None
+
+    @property
+    def address(self):
+        """
+        Server address as 'host:port'.
+        """
+        return '{}:{}'.format(*self.server_address)
+
+    def start(self):
+        """
+        Serves in a daemon thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving, closes listening socket and client connections.
+        """
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Server-Sent Events announcing data version changes.
+
+Paste serves every request on its own threadpool worker, so event
+streams are served by a separate server which keeps all idle client
+sockets in one poll loop.
+"""
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+STREAM_HEADERS = (
+    'HTTP/1.1 200 OK\r\n'
+    'Content-Type: text/event-stream\r\n'
+    'Cache-Control: no-cache\r\n'
+    'Access-Control-Allow-Origin: *\r\n'
+    '\r\n'
+    'retry: 5000\n\n'
+)
+NOT_FOUND = 'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+
+def event_message(dataset, version):
+    """
+    Formats data version change as Server-Sent Event.
+    """
+    return 'id: {}\nevent: data\ndata: {}\n\n'.format(
+        version, json.dumps({'dataset': dataset, 'version': version})
+    )
+
+
+def parse_request(request):
+    """
+    Returns dataset and Last-Event-ID of event stream request,
+    dataset is False for unknown paths.
+    """
+    lines = request.split('\r\n')
+    parts = lines[0].split()
+    path = parts[1].split('?')[0] if len(parts) > 1 else ''
+    last_id = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'last-event-id' and value.strip():
+            try:
+                last_id = int(value)
+            except ValueError:
+                pass
+    if path.rstrip('/') == '/events':
+        return None, last_id
+    prefix = '/events/'
+    if (path.startswith(prefix) and
+            path[len(prefix):] in app.config.get('DATASETS', {})):
+        return path[len(prefix):], last_id
+    return False, last_id
+
+
+class EventServer(object):
+    """
+    Streams data version events to many clients from a single thread.
+    """
+
+    def __init__(self, host='', port=0, heartbeat=15):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        self.address = self.listener.getsockname()
+        self.heartbeat = heartbeat
+        self.sockets = {}
+        self.requests = {}
+        self.clients = {}
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wakeup = os.pipe()
+        self.poller = select.poll()
+        self.poller.register(self.listener, READ_EVENTS)
+        self.poller.register(self.wakeup[0], READ_EVENTS)
+        self.running = True
+
+    def publish(self, dataset, version):
+        """
+        Queues event for clients of dataset, safe to call from any thread.
+        """
+        with self.lock:
+            self.queue.append((dataset, version))
+        os.write(self.wakeup[1], '.')
+
+    def stop(self):
+        """
+        Stops serving and closes all connections.
+        """
+        self.running = False
+        os.write(self.wakeup[1], '.')
+
+    def serve_forever(self):
+        """
+        Accepts clients and dispatches events until stopped, also when
+        stopped before serving started.
+        """
+        beat = time.time()
+        while self.running:
+            for fileno, _ in self.poller.poll(self.heartbeat * 1000):
+                if fileno == self.listener.fileno():
+                    self.accept()
+                elif fileno == self.wakeup[0]:
+                    os.read(self.wakeup[0], 4096)
+                    self.dispatch()
+                elif fileno in self.sockets:
+                    self.receive(self.sockets[fileno])
+            if time.time() - beat >= self.heartbeat:
+                beat = time.time()
+                for client in self.clients.keys():
+                    self.send(client, ':\n\n')
+        for client in self.sockets.values():
+            client.close()
+        self.listener.close()
+
+    def accept(self):
+        """
+        Accepts pending connections.
+        """
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            client.setblocking(0)
+            self.sockets[client.fileno()] = client
+            self.requests[client] = ''
+            self.poller.register(client, READ_EVENTS)
+
+    def receive(self, client):
+        """
+        Reads request of new client, closes disconnected ones.
+        """
+        try:
+            chunk = client.recv(4096)
+        except socket.error:
+            chunk = ''
+        if not chunk:
+            self.close(client)
+        elif client in self.requests:
+            self.requests[client] += chunk
+            if '\r\n\r\n' in self.requests[client]:
+                self.subscribe(client, self.requests.pop(client))
+            elif len(self.requests[client]) > 8192:
+                self.close(client)
+
+    def subscribe(self, client, request):
+        """
+        Starts event stream, sends missed event right away.
+        """
+        dataset, last_id = parse_request(request)
+        if dataset is False:
+            self.send(client, NOT_FOUND)
+            self.close(client)
+            return
+        self.clients[client] = dataset
+        version = utils.data_versions.get(dataset)
+        message = STREAM_HEADERS
+        if last_id is not None and version is not None and last_id < version:
+            message += event_message(dataset, version)
+        self.send(client, message)
+
+    def dispatch(self):
+        """
+        Sends queued events to subscribed clients.
+        """
+        with self.lock:
+            queue, self.queue = self.queue, []
+        for dataset, version in queue:
+            message = event_message(dataset, version)
+            for client, subscribed in self.clients.items():
+                if subscribed == dataset:
+                    self.send(client, message)
+
+    def send(self, client, message):
+        """
+        Writes message, dropping clients which cannot keep up.
+        """
+        try:
+            client.sendall(message)
+        except socket.error:
+            self.close(client)
+
+    def close(self, client):
+        """
+        Forgets and closes client connection.
+        """
+        try:
+            fileno = client.fileno()
+        except socket.error:
+            # already closed
+            return
+        if fileno in self.sockets:
+            self.poller.unregister(fileno)
+            del self.sockets[fileno]
+        self.requests.pop(client, None)
+        self.clients.pop(client, None)
+        client.close()
+
+
+def watch_data(interval):
+    """
+    Reloads changed datasets every interval seconds.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            utils.refresh_datasets()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Reloading data failed')
+
+
+def start_events():
+    """
+    Starts event server on EVENTS_PORT and data file watcher threads.
+    """
+    server = EventServer(
+        app.config.get('EVENTS_HOST', ''), app.config['EVENTS_PORT']
+    )
+    utils.version_listeners.append(server.publish)
+    for target, args in (
+            (server.serve_forever, ()),
+            (watch_data, (app.config.get('EVENTS_POLL', 5),))):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+    return server
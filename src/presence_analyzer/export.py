@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Export of API responses into static files.
+
+Response of URL with query string, e.g. /api/v1/users?has_data=1,
+is written to file named after path and query joined with '@', e.g.
+api/v1/users@has_data=1. Web server serving the export looks for such
+file first, e.g. in nginx:
+
+    location /api/v1/ {
+        root /path/to/export;
+        default_type application/json;
+        try_files $uri@$args $uri =404;
+    }
+"""
+import multiprocessing
+import os
+
+from flask import g
+
+from presence_analyzer.helpers import write_file
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    get_data,
+    month_rankings,
+    months_listing,
+    xml_translator
+)
+
+USER_ENDPOINTS = (
+    'mean_time_weekday',
+    'presence_weekday',
+    'presence_start_end',
+    'podium',
+    'weekly',
+    'overtime',
+)
+# Query strings pages request, keep in sync with templates
+QUERY_VARIANTS = {
+    '/users': ('has_data=1',),
+    '/months': ('counts=1',),
+}
+
+
+def api_urls():
+    """
+    Lists API URLs of current dataset worth exporting.
+    """
+    urls = []
+    for url in ('/users', '/months', '/weekly_team'):
+        urls.append(url)
+        urls.extend(
+            '{}?{}'.format(url, query) for query in QUERY_VARIANTS.get(url, ())
+        )
+    users = set(get_data()) | set(xml_translator())
+    for endpoint in USER_ENDPOINTS:
+        urls.extend(
+            '/{}/{}'.format(endpoint, user_id) for user_id in sorted(users)
+        )
+    urls.extend(
+        '/five_top/{},{}'.format(month['number'], month['year'])
+        for month in months_listing()
+    )
+    for (year, month), ranking in sorted(month_rankings().items()):
+        urls.extend(
+            '/rank/{}/{}/{}'.format(user_id, year, month)
+            for user_id in sorted(ranking['users'])
+        )
+    return urls
+
+
+def dataset_urls():
+    """
+    Lists API URLs of default and all named datasets.
+    """
+    urls = []
+    for dataset in [None] + sorted(app.config.get('DATASETS', {})):
+        prefix = '/api/v1' if dataset is None else '/api/v1/' + dataset
+        with app.app_context():
+            g.dataset = dataset
+            urls.extend(prefix + url for url in api_urls())
+    return urls
+
+
+def export_url(task):
+    """
+    Renders URL and writes response with its gzip variant under target.
+    """
+    target, url = task
+    resp = app.test_client().get(url)
+    if resp.status_code != 200:
+        return False
+    path = os.path.join(target, url.lstrip('/').replace('?', '@', 1))
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # created meanwhile by other worker
+            pass
+    write_file(path, resp.data)
+    write_file(path + '.gz', resp.data, compress=True)
+    return True
+
+
+def export_static(target, processes=None):
+    """
+    Writes responses of all API URLs into target directory mirroring
+    the URLs, rendering them in a process pool. Returns number of files.
+    """
+    tasks = [(target, url) for url in dataset_urls()]
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        return sum(pool.map(export_url, tasks, chunksize=64))
+    finally:
+        pool.close()
+        pool.join()
@@ -2,3 +2,91 @@
 """
 Helper functions used in templates.
 """
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import url_for
+
+from presence_analyzer.main import app
+
+
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.txt')
+static_manifest = {}  # pylint: disable=invalid-name
+
+
+def static_build_dir():
+    """
+    Directory holding fingerprinted copies of static files.
+    """
+    return app.config.get('STATIC_BUILD_DIR') or os.path.join(
+        tempfile.gettempdir(), 'presence_analyzer_static'
+    )
+
+
+def write_file(path, content, compress=False):
+    """
+    Writes file atomically, optionally gzip compressed.
+    """
+    temporary = '{}.{}.{}.tmp'.format(
+        path, os.getpid(), threading.current_thread().ident
+    )
+    with open(temporary, 'wb') as output:
+        if compress:
+            with gzip.GzipFile('', 'wb', 9, output, mtime=0) as archive:
+                archive.write(content)
+        else:
+            output.write(content)
+    os.rename(temporary, path)
+
+
+def build_static():
+    """
+    Copies static files under content hashed names with gzip variants.
+    """
+    target = static_build_dir()
+    manifest = {}
+    for root, _, files in os.walk(app.static_folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, app.static_folder)
+            with open(path, 'rb') as source:
+                content = source.read()
+            stem, extension = os.path.splitext(name)
+            hashed = '{}.{}{}'.format(
+                stem, hashlib.md5(content).hexdigest()[:12], extension
+            )
+            destination = os.path.join(target, hashed)
+            if not os.path.exists(destination):
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                if extension in COMPRESSIBLE:
+                    write_file(destination + '.gz', content, compress=True)
+                write_file(destination, content)
+            manifest[name.replace(os.sep, '/')] = hashed.replace(os.sep, '/')
+    static_manifest.update(manifest)
+    return manifest
+
+
+def static_url(filename):
+    """
+    URL of fingerprinted static file, falls back to plain static URL.
+    """
+    if not static_manifest:
+        build_static()
+    if filename not in static_manifest:
+        return url_for('static', filename=filename)
+    return url_for('static_asset', filename=static_manifest[filename])
+
+
+@app.context_processor
+def template_helpers():
+    """
+    Makes helpers available in templates.
+    """
+    return {
+        'static_url': static_url,
+        'events_url': app.config.get('EVENTS_URL'),
+    }
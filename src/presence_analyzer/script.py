@@ -7,7 +7,6 @@ import sys
 import urllib2
 from functools import partial
 
-import paste.script.command
 import werkzeug.script
 
 XML_DATA = os.path.join(
@@ -30,14 +29,30 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def configure_app(config=DEPLOY_CFG, debug=False):
+    from presence_analyzer import app, views
     app.config.from_pyfile(abspath(config))
     app.debug = debug
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    app = configure_app(config, debug)
+    # Static files and pages are built on first use unless PREBUILD_PAGES
+    if app.config.get('PREBUILD_PAGES'):
+        from presence_analyzer import helpers, views
+        helpers.build_static()
+        views.compile_pages()
+    # Parsing processes are forked before any thread is started
+    from presence_analyzer import utils
+    utils.start_workers()
+    if app.config.get('EVENTS_PORT'):
+        from presence_analyzer import events
+        events.start_events()
+    return app
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
@@ -49,7 +64,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = configure_app()
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -80,6 +95,7 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
@@ -115,6 +131,70 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl build_static
+    def action_build_static():
+        """Write fingerprinted and gzipped copies of static files."""
+        from presence_analyzer import helpers
+        configure_app()
+        for name, hashed in sorted(helpers.build_static().items()):
+            print name, '->', hashed
+
+    # bin/flask-ctl anomalies
+    def action_anomalies(report=('r', abspath('var', 'anomalies.json')),
+                         min_day_hours=4.0, max_arrival_shift_hours=3.0,
+                         min_weekday_share=0.5, min_weeks=4):
+        """Write report of irregular presence patterns.
+
+        Flags days shorter than '--min-day-hours', arrivals shifted by
+        more than '--max-arrival-shift-hours' from the previous day and
+        weekdays with less than '--min-weekday-share' of the usual
+        presence count for users with '--min-weeks' of data.
+        """
+        from presence_analyzer import anomalies, utils
+        app = configure_app()
+        utils.start_workers()
+        with app.app_context():
+            count = anomalies.write_report(
+                report,
+                min_day_hours=min_day_hours,
+                max_arrival_shift_hours=max_arrival_shift_hours,
+                min_weekday_share=min_weekday_share,
+                min_weeks=min_weeks,
+            )
+        print count, 'anomalies written to', report
+
+    # bin/flask-ctl export_static
+    def action_export_static(target=('t', abspath('var', 'export')),
+                             processes=0):
+        """Render every API response into static files.
+
+        Files and their gzip variants mirror the /api/v1/... URLs under
+        '--target', so a web server can serve them without the app.
+        '--processes' defaults to the number of CPUs.
+        """
+        from presence_analyzer import export
+        configure_app()
+        count = export.export_static(target, processes)
+        print count, 'responses written to', target
+
+    # bin/flask-ctl benchmark_ingest
+    def action_benchmark_ingest(path=('p', ''), repeat=3):
+        """Compare load time of plain and compressed presence CSV.
+
+        Data behind '--path' (DATA_CSV by default) is written as plain,
+        gzip, bz2 and, with lzma available, xz file and every file is
+        loaded '--repeat' times; the best time is printed.
+        """
+        from presence_analyzer import benchmark, utils
+        app = configure_app()
+        utils.start_workers()
+        results = benchmark.ingest_benchmark(
+            path or app.config['DATA_CSV'], repeat
+        )
+        line = '{kind:<6} {size:>12} bytes {rows:>9} rows {seconds:.3f}s'
+        for result in results:
+            print line.format(**result)
+
     werkzeug.script.run()
 
 
@@ -6,10 +6,31 @@ from __future__ import unicode_literals
 import os.path
 import json
 import datetime
+import gzip
+import logging
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import types
 import unittest
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from StringIO import StringIO
 
+import numpy
+from werkzeug.exceptions import HTTPException
+
+import anomalies  # pylint: disable=relative-import
+import benchmark  # pylint: disable=relative-import
+import cache  # pylint: disable=relative-import
+import events  # pylint: disable=relative-import
+import export  # pylint: disable=relative-import
+import helpers  # pylint: disable=relative-import
 import main  # pylint: disable=relative-import
 import utils  # pylint: disable=relative-import
 import views  # pylint: disable=unused-import, relative-import
@@ -21,6 +42,7 @@ TEST_DATA_CSV = os.path.join(
 TEST_XML_DATA = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'export_test.xml'
 )
+TEST_AVATAR = 'https://intranet.stxnext.pl:443/api/images/users/{}'
 
 
 # pylint: disable=maybe-no-member, too-many-public-methods
@@ -54,6 +76,64 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/')
         self.assertEqual(resp.status_code, 200)
 
+    def test_pages(self):
+        """
+        Test rendering registered pages and rejecting unknown ones.
+        """
+        self.assertIn('top_5.html', views.PAGES)
+        self.assertNotIn('base.html', views.PAGES)
+        resp = self.client.get('/podium.html')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            views.page_cache[('podium.html', '')],
+            resp.data
+        )
+        resp = self.client.get('/base.html')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('Not Found 404', resp.data)
+        resp = self.client.get('/missing.html')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_static_asset(self):
+        """
+        Test serving fingerprinted and gzipped static files.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        main.app.config['STATIC_BUILD_DIR'] = directory
+        self.addCleanup(main.app.config.pop, 'STATIC_BUILD_DIR')
+        manifest = helpers.build_static()
+        self.assertRegexpMatches(
+            manifest['js/parseInterval.js'],
+            r'^js/parseInterval\.[0-9a-f]{12}\.js$'
+        )
+        image = os.path.join(directory, manifest['img/loading.gif'])
+        self.assertTrue(os.path.isfile(image))
+        self.assertFalse(os.path.isfile(image + '.gz'))
+        with main.app.test_request_context():
+            url = helpers.static_url('js/parseInterval.js')
+            self.assertEqual(url, '/assets/' + manifest['js/parseInterval.js'])
+            self.assertEqual(
+                helpers.static_url('missing.js'),
+                '/static/missing.js'
+            )
+        script = os.path.join(main.app.static_folder, 'js', 'parseInterval.js')
+        with open(script) as source:
+            content = source.read()
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, content)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        content_type = resp.content_type
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.content_type, content_type)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(resp.data)).read(),
+            content
+        )
+
     def test_api_users(self):
         """
         Test users listing.
@@ -71,6 +151,125 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
 
+    def test_api_users_search(self):
+        """
+        Test paginated users listing with name prefix search.
+        """
+        resp = self.client.get('/api/v1/users?q=an&fields=user_id,name')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [item['name'] for item in data],
+            ['Andrzej S.', 'Anna D.', 'Anna K.', 'Anna W.']
+        )
+        self.assertEqual(data[0], {'user_id': 26, 'name': 'Andrzej S.'})
+        resp = self.client.get('/api/v1/users?q=An&limit=2')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['avatar'], TEST_AVATAR.format(26))
+        cursor = resp.headers['X-Next-Cursor']
+        resp = self.client.get('/api/v1/users?q=An&limit=2&cursor=' + cursor)
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [item['name'] for item in data],
+            ['Anna K.', 'Anna W.']
+        )
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+        resp = self.client.get('/api/v1/users?has_data=1&fields=user_id')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            data,
+            [
+                {'user_id': 141}, {'user_id': 176}, {'user_id': 26},
+                {'user_id': 62}, {'user_id': 68}, {'user_id': 49},
+                {'user_id': 11}, {'user_id': 10}
+            ]
+        )
+        for query in ('limit=0', 'limit=-1', 'limit=x', 'fields=bogus'):
+            resp = self.client.get('/api/v1/users?q=An&' + query)
+            self.assertEqual(resp.status_code, 400)
+        main.app.config['USERS_PAGE_LIMIT'] = 3
+        try:
+            resp = self.client.get('/api/v1/users?q=An&limit=50')
+        finally:
+            del main.app.config['USERS_PAGE_LIMIT']
+        self.assertEqual(len(json.loads(resp.data)), 3)
+        self.assertEqual(resp.headers['X-Next-Cursor'], '6')
+
+    def test_api_months(self):
+        """
+        Test month listing for dropdown.
+        """
+        resp = self.client.get('/api/v1/months')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 24)
+        self.assertEqual(data[0], {'number': 0, 'name': 'Jan', 'year': 2013})
+        self.assertEqual([item['year'] for item in data[::12]], [2013, 2015])
+        resp = self.client.get('/api/v1/months?counts=1')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            data[8],
+            {'number': 8, 'name': 'Sep', 'year': 2013, 'rows': 9, 'users': 2}
+        )
+        self.assertEqual(data[0]['rows'], 0)
+        resp = self.client.get('/api/v1/months?counts=0')
+        self.assertNotIn('rows', json.loads(resp.data)[0])
+
+    def test_datasets(self):
+        """
+        Test serving named datasets with memory bounded caches.
+        """
+        main.app.config['DATASETS'] = {
+            'first': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+            'second': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        resp = self.client.get('/api/v1/first/podium/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            json.loads(self.client.get('/api/v1/podium/11').data)
+        )
+        resp = self.client.get('/api/v1/third/podium/11')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('first', utils.snapshots)
+        self.assertNotIn('second', utils.snapshots)
+        main.app.config['DATASET_MEMORY_BUDGET'] = 1
+        self.addCleanup(main.app.config.pop, 'DATASET_MEMORY_BUDGET')
+        resp = self.client.get('/api/v1/second/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('first', utils.snapshots)
+        self.assertIn('second', utils.snapshots)
+        self.addCleanup(utils.evict_dataset, 'second')
+
+    def test_datasets_budget_indexes(self):
+        """
+        Test counting indexes and responses in DATASET_MEMORY_BUDGET.
+        """
+        main.app.config['DATASETS'] = {
+            'first': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+            'second': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        self.addCleanup(utils.evict_dataset, 'first')
+        self.addCleanup(utils.evict_dataset, 'second')
+        utils.evict_dataset(None)
+        self.client.get('/api/v1/second/users')
+        self.client.get('/api/v1/first/users')
+        main.app.config['DATASET_MEMORY_BUDGET'] = sum(
+            snapshot.memory() for snapshot in utils.snapshots.values()
+        ) + 1000
+        self.addCleanup(main.app.config.pop, 'DATASET_MEMORY_BUDGET')
+        self.assertIn('second', utils.snapshots)
+        resp = self.client.get('/api/v1/first/cube?group_by=user,month')
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(utils.snapshots['first'].index_size, 1000)
+        self.assertNotIn('second', utils.snapshots)
+
     def test_presence_weekday_view(self):
         """
         Test mean presence time of given user grouped by weekday.
@@ -201,6 +400,522 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_rank_view(self):
+        """
+        Test user rank among colleagues in given month.
+        """
+        resp = self.client.get('/api/v1/rank/49/2015/9')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'], 6)
+        self.assertEqual(data['hours']['rank'], 3)
+        self.assertAlmostEqual(data['hours']['percentile'], 66.667, 3)
+        self.assertAlmostEqual(data['hours']['value'], 11.785, 3)
+        self.assertEqual(data['arrival']['rank'], 3)
+        self.assertEqual(data['arrival']['value'], 11816)
+        resp = self.client.get('/api/v1/rank/49/2013/9')
+        self.assertEqual(json.loads(resp.data), 'no data')
+
+    def test_export_static(self):
+        """
+        Test exporting API responses into static files.
+        """
+        urls = export.dataset_urls()
+        self.assertIn('/api/v1/users', urls)
+        self.assertIn('/api/v1/podium/36', urls)
+        self.assertIn('/api/v1/five_top/8,2013', urls)
+        self.assertIn('/api/v1/rank/49/2015/9', urls)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        count = export.export_static(directory, 2)
+        self.assertEqual(count, len(urls))
+        path = os.path.join(directory, 'api', 'v1', 'presence_weekday', '11')
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        with open(path) as exported:
+            self.assertEqual(exported.read(), resp.data)
+        with gzip.open(path + '.gz') as exported:
+            self.assertEqual(exported.read(), resp.data)
+        path = os.path.join(directory, 'api', 'v1', 'months@counts=1')
+        resp = self.client.get('/api/v1/months?counts=1')
+        with open(path) as exported:
+            self.assertEqual(exported.read(), resp.data)
+        for page in views.PAGES:
+            html = self.client.get('/' + page).data
+            for url in re.findall(r'/api/v1/[^"\'?]*\?[^"\']*', html):
+                self.assertIn(url, urls)
+
+    def test_weekly_views(self):
+        """
+        Test weekly totals, overtime and team weekly totals.
+        """
+        resp = self.client.get('/api/v1/weekly/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['year'], 2013)
+        self.assertEqual(data[0]['week'], 37)
+        self.assertEqual(data[0]['days'], 3)
+        self.assertAlmostEqual(data[0]['hours'], 78217 / 3600.0)
+        resp = self.client.get('/api/v1/overtime/11?threshold=20')
+        data = json.loads(resp.data)
+        self.assertEqual(data['threshold'], 20)
+        self.assertEqual(
+            [(week['year'], week['week']) for week in data['weeks']],
+            [(2013, 37)]
+        )
+        self.assertAlmostEqual(data['overtime'], 95403 / 3600.0 - 20)
+        resp = self.client.get('/api/v1/overtime/11')
+        self.assertEqual(json.loads(resp.data)['weeks'], [])
+        resp = self.client.get('/api/v1/weekly/9999')
+        self.assertEqual(json.loads(resp.data), 'no data')
+        resp = self.client.get('/api/v1/weekly_team')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 9)
+        self.assertEqual(data[6]['year'], 2013)
+        self.assertEqual(data[6]['week'], 37)
+        self.assertEqual(data[6]['users'], 2)
+        self.assertAlmostEqual(data[6]['hours'], (95403 + 78217) / 3600.0)
+
+    def test_disk_cache(self):
+        """
+        Test reusing indexes and responses cached on disk after restart.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        main.app.config['CACHE_DIR'] = directory
+        self.addCleanup(main.app.config.pop, 'CACHE_DIR')
+        main.app.config['DATASETS'] = {
+            'disk': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        self.addCleanup(utils.evict_dataset, 'disk')
+        builds = []
+
+        def build(data):
+            """
+            Counts builds of index.
+            """
+            builds.append(len(data))
+            return sorted(data)
+
+        def index():
+            """
+            Builds or loads index of dataset.
+            """
+            with main.app.app_context():
+                utils.g.dataset = 'disk'
+                return utils.get_snapshot().index('test_users', build)
+
+        self.assertEqual(index(), [10, 11, 26, 49, 62, 68, 141, 176])
+        resp = self.client.get('/api/v1/disk/weekly/10')
+        self.assertTrue(os.listdir(directory))
+        utils.evict_dataset('disk')
+        self.assertEqual(index(), [10, 11, 26, 49, 62, 68, 141, 176])
+        self.assertEqual(builds, [8])
+        with main.app.app_context():
+            utils.g.dataset = 'disk'
+            snapshot = utils.get_snapshot()
+            self.assertNotIn('weekly_rollup', snapshot.indexes)
+            cached = self.client.get('/api/v1/disk/weekly/10')
+            self.assertNotIn('weekly_rollup', snapshot.indexes)
+        self.assertEqual(cached.data, resp.data)
+        self.assertEqual(cached.content_type, 'application/json')
+
+    def test_response_cache(self):
+        """
+        Test keying cached responses by view arguments and keeping
+        at most RESPONSE_CACHE_SIZE of them.
+        """
+        main.app.config['RESPONSE_CACHE_SIZE'] = 3
+        self.addCleanup(main.app.config.pop, 'RESPONSE_CACHE_SIZE')
+        with main.app.app_context():
+            responses = utils.get_snapshot().responses
+        responses.clear()
+        for number in range(5):
+            resp = self.client.get('/api/v1/months?junk={}'.format(number))
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(responses), 1)
+        for threshold in range(5):
+            self.client.get('/api/v1/overtime/10?threshold={}'.format(
+                threshold
+            ))
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(
+            responses.keys()[-1],
+            ('/api/v1/overtime/10', ('4',), 'application/json')
+        )
+
+    def test_slow_request_log(self):
+        """
+        Test logging span breakdown of requests above threshold.
+        """
+        main.app.config['DATASETS'] = {
+            'traced': {'DATA_CSV': TEST_DATA_CSV, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        self.addCleanup(utils.evict_dataset, 'traced')
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        views.SLOW_LOG.addHandler(handler)
+        self.addCleanup(views.SLOW_LOG.removeHandler, handler)
+        self.client.get('/api/v1/traced/podium/11')
+        self.assertEqual(stream.getvalue(), '')
+        self.assertIsNone(getattr(utils.trace_state, 'spans', None))
+        main.app.config['SLOW_REQUEST_SECONDS'] = 0
+        self.addCleanup(main.app.config.pop, 'SLOW_REQUEST_SECONDS')
+        utils.evict_dataset('traced')
+        self.client.get('/api/v1/traced/podium/11?detail=1')
+        line = json.loads(stream.getvalue())
+        self.assertEqual(line['path'], '/api/v1/traced/podium/11')
+        self.assertEqual(line['args'], {'detail': ['1']})
+        self.assertEqual(line['view_args'], {'user_id': 11})
+        self.assertItemsEqual(
+            line['spans'],
+            ['csv_load', 'xml_parse', 'podium_data_maker', 'json_encode']
+        )
+        self.assertEqual(line['spans']['podium_data_maker']['calls'], 1)
+        self.assertLessEqual(
+            line['spans']['csv_load']['seconds'], line['seconds']
+        )
+        main.app.config['SLOW_REQUEST_SECONDS'] = 60
+        self.client.get('/api/v1/traced/podium/10')
+        self.assertEqual(len(stream.getvalue().splitlines()), 1)
+
+    def test_memory_views(self):
+        """
+        Test memory accounting and allocation tracing admin endpoints.
+        """
+        resp = self.client.get('/api/v1/admin/memory')
+        self.assertEqual(resp.status_code, 404)
+        main.app.config['ADMIN_ENDPOINTS'] = True
+        self.addCleanup(main.app.config.pop, 'ADMIN_ENDPOINTS')
+        self.client.get('/api/v1/weekly/10')
+        resp = self.client.get('/api/v1/admin/memory')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        dataset = [
+            item for item in data['datasets'] if item['dataset'] is None
+        ][0]
+        self.assertGreater(dataset['data'], 0)
+        names = [index['name'] for index in dataset['indexes']]
+        self.assertIn("'weekly_rollup'", names)
+        indexes = sum(index['size'] for index in dataset['indexes'])
+        self.assertGreater(dataset['size'], dataset['data'] + indexes)
+        self.assertIn(TEST_DATA_CSV, [
+            shard['path'] for shard in data['caches']['shards']
+        ])
+        self.assertGreater(data['max_rss'], 0)
+        resp = self.client.get('/api/v1/admin/tracemalloc/bogus')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.post('/api/v1/admin/tracemalloc/start')
+        if resp.status_code == 501:
+            self.assertEqual(
+                json.loads(resp.data), 'tracemalloc is not available'
+            )
+            return
+        self.assertTrue(json.loads(resp.data)['tracing'])
+        self.client.post('/api/v1/admin/tracemalloc/snapshot')
+        utils.evict_dataset(None)
+        self.client.get('/api/v1/weekly/10')
+        data = json.loads(
+            self.client.get('/api/v1/admin/tracemalloc/diff?limit=5').data
+        )
+        self.assertLessEqual(len(data['allocations']), 5)
+        resp = self.client.post('/api/v1/admin/tracemalloc/stop')
+        self.assertFalse(json.loads(resp.data)['tracing'])
+
+    def test_tracemalloc_view(self):
+        """
+        Test allocation tracing endpoints with stand-in tracemalloc.
+        """
+        main.app.config['ADMIN_ENDPOINTS'] = True
+        self.addCleanup(main.app.config.pop, 'ADMIN_ENDPOINTS')
+        frame = namedtuple('Frame', 'filename lineno')
+        stat = namedtuple('Stat', 'traceback size count')
+        stat_diff = namedtuple(
+            'StatDiff', 'traceback size count size_diff count_diff'
+        )
+        directory = os.path.dirname(os.path.abspath(utils.__file__))
+        source = [frame(os.path.join(directory, 'utils.py'), 42)]
+        state = {'tracing': False, 'frames': None, 'sizes': [], 'filters': []}
+
+        class Snapshot(object):
+            """
+            Stand-in of tracemalloc snapshot with one traced line.
+            """
+
+            def __init__(self, size):
+                self.size = size
+
+            def filter_traces(self, filters):
+                """
+                Records filters.
+                """
+                state['filters'].extend(filters)
+                return self
+
+            def statistics(self, key):
+                """
+                Statistics of traced line.
+                """
+                assert key == 'lineno'
+                return [stat(source, self.size, 2)]
+
+            def compare_to(self, baseline, key):
+                """
+                Differences of traced line since baseline.
+                """
+                assert key == 'lineno'
+                return [
+                    stat_diff(
+                        source, self.size, 3, self.size - baseline.size, 1
+                    )
+                ]
+
+        def take_snapshot():
+            """
+            Snapshot growing by 100 bytes every time it is taken.
+            """
+            state['sizes'].append(100 * (len(state['sizes']) + 1))
+            return Snapshot(state['sizes'][-1])
+
+        module = types.ModuleType(b'tracemalloc')
+        module.start = lambda frames: state.update(tracing=True, frames=frames)
+        module.stop = lambda: state.update(tracing=False)
+        module.is_tracing = lambda: state['tracing']
+        module.get_traced_memory = lambda: (1000, 2000)
+        module.Filter = lambda inclusive, pattern: (inclusive, pattern)
+        module.take_snapshot = take_snapshot
+        sys.modules['tracemalloc'] = module
+        self.addCleanup(sys.modules.pop, 'tracemalloc')
+        resp = self.client.post('/api/v1/admin/tracemalloc/start?frames=3')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            {'tracing': True, 'traced': 1000, 'peak': 2000}
+        )
+        self.assertEqual(state['frames'], 3)
+        resp = self.client.post('/api/v1/admin/tracemalloc/snapshot')
+        self.assertEqual(
+            json.loads(resp.data)['allocations'],
+            [
+                {
+                    'file': 'utils.py', 'line': 42, 'size': 100,
+                    'count': 2, 'size_diff': 100, 'count_diff': 2,
+                },
+            ]
+        )
+        self.assertEqual(
+            state['filters'],
+            [(True, os.path.join(directory, '*'))]
+        )
+        resp = self.client.get('/api/v1/admin/tracemalloc/diff?limit=0')
+        self.assertEqual(json.loads(resp.data)['allocations'], [])
+        resp = self.client.get('/api/v1/admin/tracemalloc/diff')
+        self.assertEqual(
+            json.loads(resp.data)['allocations'],
+            [
+                {
+                    'file': 'utils.py', 'line': 42, 'size': 300,
+                    'count': 3, 'size_diff': 200, 'count_diff': 1,
+                },
+            ]
+        )
+        resp = self.client.post('/api/v1/admin/tracemalloc/stop')
+        self.assertEqual(json.loads(resp.data), {'tracing': False})
+        self.assertEqual(utils.allocation_snapshots, {})
+
+    def test_object_size(self):
+        """
+        Test approximating size of nested structures.
+        """
+        shared = [1, 2, 3]
+        once = utils.object_size({'a': shared})
+        twice = utils.object_size({'a': shared, 'b': shared})
+        self.assertEqual(twice - once, sys.getsizeof('b'))
+        self.assertGreater(utils.object_size(numpy.zeros(1000)), 8000)
+        table = numpy.zeros((1000, 4))
+        columns = {'a': table[:, 0], 'b': table[:, 1].reshape(10, 100)}
+        self.assertGreater(utils.object_size(columns), table.nbytes)
+        self.assertLess(utils.object_size(columns), 2 * table.nbytes)
+
+    def test_cube_view(self):
+        """
+        Test grouping and filtering presence cube.
+        """
+        resp = self.client.get('/api/v1/cube')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['days'], 20)
+        self.assertEqual(data[0]['seconds'], 535778)
+        self.assertEqual(data[0]['ends'] - data[0]['starts'], 535778)
+        resp = self.client.get('/api/v1/cube?group_by=year,month&user=11')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [(row['year'], row['month'], row['days']) for row in data],
+            [(2013, month, 1) for month in range(4, 9)] + [(2013, 9, 6)]
+        )
+        self.assertNotIn('user', data[0])
+        resp = self.client.get(
+            '/api/v1/cube?group_by=user,bogus&month=9&user=10'
+        )
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                {
+                    'user': 10,
+                    'days': 3,
+                    'seconds': 78217,
+                    'starts': 107263,
+                    'ends': 185480,
+                },
+            ]
+        )
+        for query in ('user=x,10', 'year=--5', 'month=9,'):
+            resp = self.client.get('/api/v1/cube?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_copresence_view(self):
+        """
+        Test days and overlapping hours of users present together.
+        """
+        resp = self.client.get('/api/v1/copresence?users=11,10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'], [11, 10])
+        self.assertEqual(
+            [(day['date'], day['overlap']) for day in data['days']],
+            [('2013-09-10', 15409), ('2013-09-11', 24465),
+             ('2013-09-12', 21159)]
+        )
+        self.assertEqual(data['overlap'], 61033)
+        resp = self.client.get(
+            '/api/v1/copresence?users=10,11&from=2013-09-11&to=2013-09-30'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [day['date'] for day in data['days']],
+            ['2013-09-11', '2013-09-12']
+        )
+        resp = self.client.get(
+            '/api/v1/copresence?users=10,11&from=2013-09-11&to=bogus'
+        )
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/copresence?users=10,68')
+        self.assertEqual(json.loads(resp.data)['days'], [])
+
+    def test_response_encodings(self):
+        """
+        Test negotiating columnar JSON and MessagePack responses.
+        """
+        url = '/api/v1/presence_weekday/10'
+        rows = json.loads(self.client.get(url).data)
+        resp = self.client.get(
+            url, headers={'Accept': utils.COLUMNS_TYPE}
+        )
+        self.assertEqual(resp.content_type, utils.COLUMNS_TYPE)
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        self.assertEqual(json.loads(resp.data), map(list, zip(*rows)))
+        resp = self.client.get(
+            url, headers={'Accept': 'application/x-msgpack'}
+        )
+        msgpack = utils.msgpack_module()
+        if msgpack is None:
+            self.assertEqual(resp.content_type, 'application/json')
+        else:
+            self.assertEqual(resp.content_type, 'application/x-msgpack')
+            self.assertEqual(msgpack.unpackb(resp.data, raw=False), rows)
+        resp = self.client.get(
+            '/api/v1/months?counts=1',
+            headers={'Accept': 'text/html, application/json;q=0.9'}
+        )
+        self.assertEqual(resp.content_type, 'application/json')
+        utils.optional_modules.clear()
+        sys.modules['msgpack'], module = None, sys.modules.get('msgpack')
+        try:
+            self.assertIsNone(utils.msgpack_module())
+        finally:
+            del sys.modules['msgpack']
+            if module is not None:
+                sys.modules['msgpack'] = module
+        self.assertIsNone(utils.msgpack_module())
+        utils.optional_modules.clear()
+        self.assertIs(utils.msgpack_module(), msgpack)
+
+    def test_changes_view(self):
+        """
+        Test listing presence rows changed since data version.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'presence.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATASETS'] = {
+            'delta': {'DATA_CSV': path, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        self.addCleanup(utils.evict_dataset, 'delta')
+        url = '/api/v1/delta/changes?since={}'
+        resp = self.client.get(url.format(0))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertTrue(data['resync'])
+        version, epoch = data['version'], data['epoch']
+        resp = self.client.get(url.format(version))
+        self.assertEqual(
+            json.loads(resp.data),
+            {'version': version, 'epoch': epoch, 'changes': []}
+        )
+        resp = self.client.get(url.format(version + 36))
+        self.assertTrue(json.loads(resp.data)['resync'])
+        resp = self.client.get(url.format(version) + '&epoch=' + epoch)
+        self.assertEqual(json.loads(resp.data)['changes'], [])
+        resp = self.client.get(url.format(version) + '&epoch=restarted')
+        self.assertTrue(json.loads(resp.data)['resync'])
+
+        def reload_data(line):
+            """
+            Appends line to data file and publishes new snapshot.
+            """
+            with open(path, 'a') as csvfile:
+                csvfile.write(line)
+            with main.app.app_context():
+                utils.g.dataset = 'delta'
+                return utils.publish_snapshot('delta')
+
+        reload_data('10,2013-09-13,09:00:00,17:00:00\n')
+        reload_data('11,2013-09-05,08:00:00,15:00:00\n')
+        resp = self.client.get(url.format(version))
+        self.assertEqual(
+            json.loads(resp.data),
+            {
+                'version': version + 2,
+                'epoch': epoch,
+                'changes': [
+                    {
+                        'user_id': 10, 'date': '2013-09-13',
+                        'start': '09:00:00', 'end': '17:00:00'
+                    },
+                    {
+                        'user_id': 11, 'date': '2013-09-05',
+                        'start': '08:00:00', 'end': '15:00:00'
+                    }
+                ]
+            }
+        )
+        main.app.config['CHANGE_LOG_VERSIONS'] = 1
+        self.addCleanup(main.app.config.pop, 'CHANGE_LOG_VERSIONS')
+        reload_data('10,2013-09-16,09:00:00,17:00:00\n')
+        resp = self.client.get(url.format(version + 1))
+        self.assertTrue(json.loads(resp.data)['resync'])
+        resp = self.client.get(url.format(version + 2))
+        self.assertEqual(len(json.loads(resp.data)['changes']), 1)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -239,6 +954,222 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_data_files(self):
+        """
+        Test resolving DATA_CSV into a list of shards.
+        """
+        self.assertEqual(utils.data_files(TEST_DATA_CSV), [TEST_DATA_CSV])
+        directory = os.path.dirname(TEST_DATA_CSV)
+        data = utils.data_files(directory)
+        self.assertIn(os.path.join(directory, 'test_data.csv'), data)
+        self.assertEqual(data, sorted(data))
+        data = utils.data_files(os.path.join(directory, 'test_*.csv'))
+        self.assertEqual(data, [os.path.join(directory, 'test_data.csv')])
+
+    def test_load_shards(self):
+        """
+        Test parsing CSV shards and merging them into one mapping.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.readlines()
+        paths = []
+        for number, chunk in enumerate([lines[:7], lines[7:14], lines[14:]]):
+            path = os.path.join(directory, 'shard{}.csv'.format(number))
+            with open(path, 'w') as shard:
+                shard.writelines(chunk)
+            paths.append(path)
+        shards = utils.load_shards(paths)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(
+            utils.merge_shards(shards),
+            utils.parse_csv(TEST_DATA_CSV)
+        )
+        self.assertIs(utils.merge_shards(shards[:1]), shards[0])
+        self.assertEqual(
+            utils.Snapshot(shards[0], {}, paths[:1]).shards_size, 0
+        )
+        snapshot = utils.Snapshot(utils.merge_shards(shards), {}, paths)
+        self.assertGreater(snapshot.shards_size, 0)
+        self.assertLess(snapshot.shards_size, snapshot.size)
+        self.assertGreaterEqual(
+            snapshot.memory(), snapshot.size + snapshot.shards_size
+        )
+        self.assertIs(utils.load_shards(paths)[0], shards[0])
+        with open(paths[0], 'a') as shard:
+            shard.write('header,line\n10,2013-13-45,09:00:00,17:00:00\n')
+        data = utils.load_shards(paths)
+        self.assertIsNot(data[0], shards[0])
+        self.assertEqual(data[0], shards[0])
+        self.assertIs(data[1], shards[1])
+        utils.load_shards(paths[1:], paths)
+        self.assertNotIn(paths[0], utils.shard_cache)
+
+    def test_split_ranges(self):
+        """
+        Test splitting CSV file into newline-aligned byte ranges.
+        """
+        size = os.path.getsize(TEST_DATA_CSV)
+        data = utils.split_ranges(TEST_DATA_CSV, 100)
+        self.assertGreater(len(data), 1)
+        self.assertEqual(data[0][1], 0)
+        self.assertEqual(data[-1][2], size)
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            for path, start, end in data:
+                self.assertEqual(path, TEST_DATA_CSV)
+                csvfile.seek(end - 1)
+                self.assertEqual(csvfile.read(1), '\n')
+        data = utils.split_ranges(TEST_DATA_CSV, size * 2)
+        self.assertEqual(data, [(TEST_DATA_CSV, 0, size)])
+
+    def test_parallel_ranges(self):
+        """
+        Test parallel byte range parsing gives the serial result.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'presence.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.readlines()
+        lines.insert(5, '10,2013-09-10,9:xx:05,17:59:52\n')
+        lines.insert(0, 'user_id,date,start,end\n')
+        with open(path, 'w') as csvfile:
+            csvfile.writelines(lines)
+        tasks = utils.split_ranges(path, 64)
+        serial = utils.map_ranges(tasks)
+        main.app.config['DATA_WORKERS'] = 2
+        self.addCleanup(main.app.config.pop, 'DATA_WORKERS')
+        self.addCleanup(utils.stop_workers)
+        pool = utils.start_workers()
+        self.assertIsNotNone(pool)
+        self.assertIs(utils.start_workers(), pool)
+        results = utils.map_ranges(tasks)
+        self.assertEqual(results, serial)
+        self.assertEqual(
+            utils.collect_ranges(results),
+            utils.parse_csv(TEST_DATA_CSV)
+        )
+        problems = [problem for _, _, items in results for problem in items]
+        self.assertEqual(len(problems), 2)
+        self.assertEqual(sum(lines for _, lines, _ in results), len(lines))
+        columns = results[0][0]
+        self.assertEqual(columns[0].typecode, 'l')
+        self.assertEqual(len(set(len(column) for column in columns)), 1)
+
+    def test_compressed_csv(self):
+        """
+        Test streaming gzip and bz2 compressed CSV files.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            copies = benchmark.write_copies(csvfile.read(), directory)
+        disguised = os.path.join(directory, 'archive.dat')
+        shutil.copy(copies['bz2'], disguised)
+        self.assertEqual(utils.compression(copies['plain']), None)
+        self.assertEqual(utils.compression(copies['gzip']), 'gzip')
+        self.assertEqual(utils.compression(disguised), 'bz2')
+        self.assertEqual(
+            utils.split_ranges(copies['gzip'], 64),
+            [(copies['gzip'], 0, None)]
+        )
+        expected = utils.parse_csv(TEST_DATA_CSV)
+        for path in (copies['gzip'], copies['bz2'], disguised):
+            self.assertEqual(utils.parse_csv(path), expected)
+        self.assertEqual(
+            utils.parse_range((copies['gzip'], 0, None))[1],
+            utils.parse_range(
+                (TEST_DATA_CSV, 0, os.path.getsize(TEST_DATA_CSV))
+            )[1]
+        )
+        self.assertEqual(
+            utils.data_files(directory),
+            sorted(copies.values())
+        )
+        results = benchmark.ingest_benchmark(TEST_DATA_CSV, repeat=1)
+        self.assertEqual(results[0]['kind'], 'plain')
+        self.assertEqual(set(result['rows'] for result in results), set([20]))
+
+    def test_calendar_index(self):
+        """
+        Test counting rows and users per year and month.
+        """
+        data = utils.calendar_index()
+        self.assertIs(data, utils.calendar_index())
+        self.assertEqual(data[(2013, 9)], {'rows': 9, 'users': 2})
+        self.assertEqual(data.keys(), sorted(data.keys()))
+        self.assertEqual(
+            sum(item['rows'] for item in data.values()),
+            sum(len(dates) for dates in utils.get_data().values())
+        )
+
+    def test_snapshot(self):
+        """
+        Test publishing data snapshots by reference swap.
+        """
+        with main.app.app_context():
+            snapshot = utils.get_snapshot()
+            self.assertIs(utils.get_data(), snapshot.data)
+            self.assertIs(utils.xml_translator(), snapshot.users)
+            self.assertIs(
+                utils.calendar_index(),
+                snapshot.indexes['calendar_index']
+            )
+            published = utils.publish_snapshot(None)
+            self.assertIsNot(published, snapshot)
+            self.assertIs(utils.get_snapshot(), snapshot)
+        with main.app.app_context():
+            self.assertIs(utils.get_snapshot(), published)
+            self.assertIs(utils.get_data(), snapshot.data)
+            self.assertIs(published.indexes, snapshot.indexes)
+            self.assertEqual(published.version, snapshot.version)
+        main.app.config['DATA_MAX_AGE'] = 0
+        self.addCleanup(main.app.config.pop, 'DATA_MAX_AGE')
+        lock = utils.reload_lock(None)
+        with lock:
+            self.assertIs(utils.published_snapshot(), published)
+        self.assertIsNot(utils.published_snapshot(), published)
+
+    def test_rank_position(self):
+        """
+        Test ranking value in sorted values.
+        """
+        values = [1, 2, 2, 5]
+        self.assertEqual(
+            utils.rank_position(values, 5, descending=True),
+            {'rank': 1, 'percentile': 100.0}
+        )
+        self.assertEqual(
+            utils.rank_position(values, 2, descending=True),
+            {'rank': 2, 'percentile': 75.0}
+        )
+        self.assertEqual(
+            utils.rank_position(values, 2),
+            {'rank': 2, 'percentile': 75.0}
+        )
+        self.assertEqual(
+            utils.rank_position(values, 5),
+            {'rank': 4, 'percentile': 25.0}
+        )
+
+    def test_iso_weeks(self):
+        """
+        Test ISO years and weeks of date ordinals.
+        """
+        dates = [
+            datetime.date(2013, 9, 10), datetime.date(2015, 12, 31),
+            datetime.date(2016, 1, 3), datetime.date(2014, 12, 29),
+            datetime.date(2012, 1, 1),
+        ]
+        years, weeks = utils.iso_weeks(
+            numpy.array([date.toordinal() for date in dates])
+        )
+        self.assertEqual(
+            zip(years.tolist(), weeks.tolist()),
+            [date.isocalendar()[:2] for date in dates]
+        )
+
     def test_seconds_since_midnight(self):
         """
         Test calculation of secounds since midnight.
@@ -570,6 +1501,73 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_presence_cube(self):
+        """
+        Test presence cube of user, year, month and weekday.
+        """
+        with main.app.app_context():
+            cube = utils.presence_cube()
+            rows = utils.cube_query(
+                ['weekday'], {'year': [2015], 'month': [9]}
+            )
+        self.assertEqual(cube['tensor'].shape, (4, 8, 2, 12, 7))
+        self.assertEqual(list(cube['labels']['year']), [2013, 2015])
+        self.assertEqual(cube['tensor'][1].sum(), 20)
+        self.assertEqual(
+            [row['weekday'] for row in rows], [0, 1, 2, 4, 5, 6]
+        )
+        self.assertEqual(rows[0]['seconds'], 24426)
+        self.assertEqual(rows[0]['days'], 1)
+
+    def test_copresence(self):
+        """
+        Test intersecting attendance bitsets and presence intervals.
+        """
+        with main.app.app_context():
+            bitsets = utils.attendance_bitsets()['bitsets']
+            days = utils.copresence(
+                [10, 11],
+                datetime.date(2013, 9, 11),
+                datetime.date(2013, 9, 11)
+            )
+            self.assertEqual(utils.copresence([10, 999]), [])
+            self.assertEqual(len(utils.copresence([11])), 11)
+        self.assertEqual(bitsets[10], {2013: 0b111 << 252})
+        self.assertEqual(
+            days,
+            [
+                {
+                    'date': '2013-09-11',
+                    'start': 33592,
+                    'end': 58057,
+                    'overlap': 24465,
+                },
+            ]
+        )
+        self.assertEqual(utils.year_mask(2012), (1 << 366) - 1)
+        self.assertEqual(
+            utils.year_mask(
+                2013, datetime.date(2012, 5, 1), datetime.date(2013, 1, 2)
+            ),
+            0b11
+        )
+        self.assertEqual(utils.year_mask(2013, datetime.date(2014, 1, 1)), 0)
+
+    def test_columns(self):
+        """
+        Test converting rows to columnar layout.
+        """
+        self.assertEqual(
+            utils.columns([('Mon', 1), ['Tue', 2]]),
+            [['Mon', 'Tue'], [1, 2]]
+        )
+        self.assertEqual(
+            utils.columns({'weeks': [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]}),
+            {'weeks': {'a': [1, 3], 'b': [2, 4]}}
+        )
+        for kept in ([(1, 2), (3,)], [{'a': 1}, {'b': 2}], [1, 2], [], 'x'):
+            self.assertEqual(utils.columns(kept), kept)
+
     def test_user_validate(self):
         """
         Test checking if user exist.
@@ -591,6 +1589,825 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_admission_sheds_load(self):
+        """
+        Test rejecting calls above concurrency limit and queue size.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.admission(limit=1, queue=0)
+        def slow():
+            """
+            Blocks until released.
+            """
+            started.set()
+            release.wait()
+            return 'done'
+
+        results = []
+        worker = threading.Thread(target=lambda: results.append(slow()))
+        worker.start()
+        started.wait()
+        with main.app.app_context():
+            with self.assertRaises(HTTPException) as context:
+                slow()
+        response = context.exception.response
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        release.set()
+        worker.join()
+        self.assertEqual(results, ['done'])
+        with main.app.app_context():
+            self.assertEqual(slow(), 'done')
+        self.assertEqual(slow.admission['running'], 0)
+
+    def test_coalesce(self):
+        """
+        Test sharing one computation among identical concurrent calls.
+        """
+        calls = []
+        release = threading.Event()
+
+        @utils.coalesce
+        def compute(value):
+            """
+            Counts calls and waits until released.
+            """
+            calls.append(value)
+            release.wait()
+            return [value]
+
+        results = []
+
+        def call():
+            """
+            Calls compute within application context.
+            """
+            with main.app.app_context():
+                results.append(compute(5))
+
+        workers = [threading.Thread(target=call) for _ in range(5)]
+        for worker in workers:
+            worker.start()
+        while len(utils.in_flight) < 1:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        release.set()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(calls, [5])
+        self.assertEqual(results, [[5]] * 5)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(utils.in_flight, {})
+
+    def test_coalesce_error(self):
+        """
+        Test raising error of shared call with its original traceback.
+        """
+        release = threading.Event()
+
+        def fail():
+            """
+            Raises error when released.
+            """
+            release.wait()
+            raise ValueError('broken')
+
+        @utils.coalesce
+        def compute():
+            """
+            Fails in nested call.
+            """
+            fail()
+
+        frames = []
+
+        def call():
+            """
+            Calls compute within application context, keeping names
+            of functions in traceback of its error.
+            """
+            with main.app.app_context():
+                try:
+                    compute()
+                except ValueError:
+                    frames.append([
+                        frame[2]
+                        for frame in traceback.extract_tb(sys.exc_info()[2])
+                    ])
+
+        workers = [threading.Thread(target=call) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        while len(utils.in_flight) < 1:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        release.set()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(frames), 3)
+        for names in frames:
+            self.assertEqual(names[-2:], ['compute', 'fail'])
+        self.assertEqual(utils.in_flight, {})
+
+
+class PresenceAnalyzerAnomaliesTestCase(unittest.TestCase):
+    """
+    Anomaly detection tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update(
+            {
+                'XML_DATA': TEST_XML_DATA,
+                'DATA_CSV': TEST_DATA_CSV
+            }
+        )
+
+    def test_presence_columns(self):
+        """
+        Test presence data as numpy columns.
+        """
+        data = utils.presence_columns()
+        self.assertEqual(len(data['users']), 20)
+        self.assertEqual(data['users'][0], 10)
+        self.assertEqual(
+            data['dates'][0],
+            datetime.date(2013, 9, 10).toordinal()
+        )
+        self.assertEqual(data['starts'][0], 34745)
+        self.assertEqual(data['ends'][0], 64792)
+
+    def test_short_days(self):
+        """
+        Test flagging too short days.
+        """
+        data = anomalies.short_days(utils.presence_columns(), 2)
+        self.assertEqual(
+            data,
+            [
+                {
+                    'rule': 'short_day', 'user_id': 11, 'hours': 1.78,
+                    'date': datetime.date(2013, 4, 13)
+                },
+                {
+                    'rule': 'short_day', 'user_id': 11, 'hours': 1.78,
+                    'date': datetime.date(2013, 9, 13)
+                }
+            ]
+        )
+
+    def test_arrival_shifts(self):
+        """
+        Test flagging sudden shifts of arrival time.
+        """
+        data = anomalies.arrival_shifts(utils.presence_columns(), 2)
+        self.assertEqual(
+            [(item['user_id'], item['date']) for item in data],
+            [
+                (11, datetime.date(2013, 5, 12)),
+                (11, datetime.date(2013, 9, 13))
+            ]
+        )
+        self.assertEqual(data[0]['shift_hours'], 2.97)
+
+    def test_missing_weekdays(self):
+        """
+        Test flagging rarely present weekdays.
+        """
+        data = anomalies.missing_weekdays(utils.presence_columns(), 0.6, 4)
+        self.assertEqual(
+            data,
+            [
+                {
+                    'rule': 'missing_weekday', 'user_id': 11,
+                    'weekday': 'Mon', 'days': 1, 'typical': 1.8
+                }
+            ]
+        )
+        data = anomalies.missing_weekdays(utils.presence_columns(), 0.6, 30)
+        self.assertEqual(data, [])
+
+    def test_write_report(self):
+        """
+        Test writing anomaly report.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'report.json')
+        count = anomalies.write_report(path, min_day_hours=2)
+        with open(path) as report:
+            data = json.load(report)
+        self.assertEqual(len(data['anomalies']), count)
+        self.assertEqual(data['rules'], {'min_day_hours': 2})
+        self.assertEqual(data['anomalies'][0]['date'], '2013-04-13')
+
+
+class PresenceAnalyzerEventsTestCase(unittest.TestCase):
+    """
+    Data version events tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update(
+            {
+                'XML_DATA': TEST_XML_DATA,
+                'DATA_CSV': TEST_DATA_CSV
+            }
+        )
+        self.server = events.EventServer('127.0.0.1', 0, heartbeat=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.stop()
+        self.thread.join()
+
+    def connect(self, path, last_id=None):
+        """
+        Opens event stream connection.
+        """
+        client = socket.create_connection(self.server.address, 5)
+        self.addCleanup(client.close)
+        request = 'GET {} HTTP/1.1\r\nHost: localhost\r\n'.format(path)
+        if last_id is not None:
+            request += 'Last-Event-ID: {}\r\n'.format(last_id)
+        client.sendall(request + '\r\n')
+        return client
+
+    def read_until(self, client, text):
+        """
+        Reads from client until text is received.
+        """
+        received = ''
+        while text not in received:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        return received
+
+    def test_parse_request(self):
+        """
+        Test parsing event stream request.
+        """
+        self.assertEqual(
+            events.parse_request(
+                'GET /events HTTP/1.1\r\nLast-Event-ID: 7\r\n\r\n'
+            ),
+            (None, 7)
+        )
+        self.assertEqual(
+            events.parse_request('GET /other HTTP/1.1\r\n\r\n'),
+            (False, None)
+        )
+
+    def test_event_stream(self):
+        """
+        Test streaming data version events.
+        """
+        utils.data_versions.setdefault(None, 1)
+        version = utils.data_versions[None]
+        client = self.connect('/events', version - 1)
+        data = self.read_until(client, 'id: {}\n'.format(version))
+        self.assertIn('text/event-stream', data)
+        self.assertIn('id: {}\n'.format(version), data)
+        other = self.connect('/events')
+        self.read_until(other, 'retry: 5000\n\n')
+        self.server.publish(None, version + 1)
+        self.server.publish('other', version + 2)
+        message = events.event_message(None, version + 1)
+        self.assertIn(message, self.read_until(other, message))
+        self.assertNotIn('other', self.read_until(other, ':\n\n'))
+        missing = self.connect('/events/missing')
+        self.assertIn('404', self.read_until(missing, '\r\n\r\n'))
+
+    def test_refresh_datasets(self):
+        """
+        Test reloading changed datasets and announcing new versions.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'presence.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATASETS'] = {
+            'watched': {'DATA_CSV': path, 'XML_DATA': TEST_XML_DATA},
+        }
+        self.addCleanup(main.app.config.pop, 'DATASETS')
+        self.addCleanup(utils.evict_dataset, 'watched')
+        published = []
+        utils.version_listeners.append(
+            lambda dataset, version: published.append((dataset, version))
+        )
+        self.addCleanup(utils.version_listeners.pop)
+        with main.app.app_context():
+            utils.g.dataset = 'watched'
+            version = utils.get_snapshot().version
+        self.assertEqual(published, [('watched', version)])
+        utils.refresh_datasets()
+        self.assertEqual(len(published), 1)
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+        utils.refresh_datasets()
+        self.assertEqual(published[1], ('watched', version + 1))
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start memcached stand-in.
+        """
+        main.app.config.update(
+            {
+                'XML_DATA': TEST_XML_DATA,
+                'DATA_CSV': TEST_DATA_CSV
+            }
+        )
+        self.memcached = cache.MemcachedStandIn().start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.memcached.stop()
+        shutil.rmtree(self.directory)
+
+    def test_backends(self):
+        """
+        Test storing, expiring and deleting values in every backend.
+        """
+        backends = [
+            cache.DictBackend(),
+            cache.FileBackend(self.directory),
+            cache.MemcachedBackend([self.memcached.address]),
+        ]
+        missing = object()
+        for backend in backends:
+            key = ('dataset', 'name', (1, 2))
+            self.assertIs(backend.get(key, missing), missing)
+            backend.set(key, {'value': [1, 2]})
+            self.assertEqual(backend.get(key), {'value': [1, 2]})
+            backend.set(key, None, 60)
+            self.assertIs(backend.get(key, missing), None)
+            backend.set(key, 'stale', -1)
+            self.assertIs(backend.get(key, missing), missing)
+            backend.set(key, 'value')
+            backend.delete(key)
+            self.assertIs(backend.get(key, missing), missing)
+        self.assertEqual(self.memcached.storage, {})
+
+    def test_memcached_unavailable(self):
+        """
+        Test reading failures of memcached as misses.
+        """
+        address = self.memcached.address
+        self.memcached.stop()
+        self.memcached = cache.MemcachedStandIn().start()
+        backend = cache.MemcachedBackend([address], timeout=0.5)
+        backend.set('key', 'value')
+        self.assertEqual(backend.get('key', 'default'), 'default')
+
+    def test_persisted_responses(self):
+        """
+        Test serving responses and parsed CSV ranges kept in file backend
+        after restart, without parsing files or computing responses.
+        """
+        main.app.config.update(
+            {'CACHE_BACKEND': 'file', 'CACHE_DIR': self.directory}
+        )
+        for key in ('CACHE_BACKEND', 'CACHE_DIR'):
+            self.addCleanup(main.app.config.pop, key)
+        self.addCleanup(utils.evict_dataset, None)
+        client = main.app.test_client()
+        url = '/api/v1/presence_weekday/10'
+        utils.evict_dataset(None)
+        with main.app.app_context():
+            self.assertIsNotNone(utils.get_snapshot().digest)
+        body = client.get(url).data
+        utils.evict_dataset(None)
+
+        def broken(*args):
+            """
+            Fails when called.
+            """
+            raise AssertionError('called with {!r}'.format(args))
+
+        parse_lines = utils.parse_lines
+        group_by_weekday = views.group_by_weekday
+        utils.parse_lines = views.group_by_weekday = broken
+        try:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, body)
+            self.assertEqual(resp.headers['Vary'], 'Accept')
+            with main.app.app_context():
+                data = utils.get_data()
+        finally:
+            utils.parse_lines = parse_lines
+            views.group_by_weekday = group_by_weekday
+        self.assertEqual(data, utils.parse_csv(TEST_DATA_CSV))
+        resp = client.get(url, headers={'Accept': utils.COLUMNS_TYPE})
+        self.assertEqual(resp.content_type, utils.COLUMNS_TYPE)
+
+    def test_shared_indexes(self):
+        """
+        Test sharing memoized values and indexes through memcached.
+        """
+        utils.evict_dataset(None)
+        with main.app.app_context():
+            self.assertIsNone(utils.get_snapshot().digest)
+        self.assertNotIn(TEST_DATA_CSV, utils.content_digests)
+        utils.evict_dataset(None)
+        main.app.config.update(
+            {
+                'CACHE_BACKEND': 'memcached',
+                'CACHE_SERVERS': [self.memcached.address],
+                'DATASETS': {
+                    'node': {
+                        'DATA_CSV': TEST_DATA_CSV,
+                        'XML_DATA': TEST_XML_DATA,
+                    },
+                    'copy': {
+                        'DATA_CSV': os.path.join(self.directory, 'data.csv'),
+                        'XML_DATA': os.path.join(self.directory, 'data.xml'),
+                    },
+                },
+            }
+        )
+        for key in ('CACHE_BACKEND', 'CACHE_SERVERS', 'DATASETS'):
+            self.addCleanup(main.app.config.pop, key)
+        self.addCleanup(utils.evict_dataset, 'node')
+        self.addCleanup(utils.evict_dataset, 'copy')
+        shutil.copy(TEST_DATA_CSV, os.path.join(self.directory, 'data.csv'))
+        shutil.copy(TEST_XML_DATA, os.path.join(self.directory, 'data.xml'))
+        calls = []
+
+        @memoize()
+        def shared_calculation():
+            """
+            Counts calculations.
+            """
+            calls.append(None)
+            return len(calls)
+
+        def rollup(dataset='node'):
+            """
+            Weekly rollup of dataset, built or fetched from memcached.
+            """
+            with main.app.app_context():
+                utils.g.dataset = dataset
+                return utils.weekly_rollup()
+
+        with main.app.app_context():
+            self.assertEqual(shared_calculation(), 1)
+            self.assertEqual(shared_calculation(), 1)
+        built = rollup()
+        stored = len(self.memcached.storage)
+        self.assertIsNotNone(utils.snapshots['node'].digest)
+        utils.evict_dataset('node')
+        fetched = rollup()
+        self.assertIsNot(fetched, built)
+        self.assertEqual(list(fetched['seconds']), list(built['seconds']))
+        self.assertEqual(len(self.memcached.storage), stored)
+        copied = rollup('copy')
+        self.assertEqual(list(copied['seconds']), list(built['seconds']))
+        # only parsed ranges of the copy are added, under its path
+        self.assertEqual(len(self.memcached.storage), stored + 1)
+        with self.assertRaises(ValueError):
+            main.app.config['CACHE_BACKEND'] = 'redis'
+            utils.cache_backend()
+
+
+class PresenceAnalyzerStartupTestCase(unittest.TestCase):
+    """
+    Process startup tests.
+    """
+
+    def import_time(self, module, statement=''):
+        """
+        Seconds spent importing module and running statement after it
+        in a fresh interpreter and modules loaded. Without statement,
+        Python 3.7+ reports cumulative time of -X importtime.
+        """
+        code = (
+            'import sys, time\n'
+            'start = time.time()\n'
+            'import {0}\n'
+            '{1}\n'
+            'print(time.time() - start)\n'
+            'print(" ".join(sorted(sys.modules)))\n'
+        ).format(module, statement)
+        options = []
+        if sys.version_info >= (3, 7) and not statement:
+            options = ['-X', 'importtime']
+        process = subprocess.Popen(
+            [sys.executable] + options + ['-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        seconds, modules = stdout.decode('utf-8').splitlines()
+        seconds = float(seconds)
+        for line in stderr.decode('utf-8').splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                seconds = int(fields[1]) / 1000000.0
+        return seconds, modules.split()
+
+    def test_import_time_budget(self):
+        """
+        Test importing views within IMPORT_TIME_BUDGET seconds without
+        loading numpy, Mako or Paste.
+        """
+        budget = float(os.environ.get('IMPORT_TIME_BUDGET', 1.0))
+        seconds, modules = self.import_time('presence_analyzer.views')
+        self.assertLessEqual(seconds, budget)
+        for lazy in ('numpy', 'flask_mako', 'mako', 'paste.script'):
+            self.assertNotIn(lazy, modules)
+
+    def test_configure_time_budget(self):
+        """
+        Test configuring app for shell and Paste workers within
+        IMPORT_TIME_BUDGET seconds without rendering pages.
+        """
+        budget = float(os.environ.get('IMPORT_TIME_BUDGET', 1.0))
+        handle, config = tempfile.mkstemp(suffix='.cfg')
+        os.write(handle, b'DEBUG = False\n')
+        os.close(handle)
+        self.addCleanup(os.remove, config)
+        for function in ('configure_app', 'make_app'):
+            seconds, modules = self.import_time(
+                'presence_analyzer.script',
+                'presence_analyzer.script.{}(config={!r})'.format(
+                    function, str(config)
+                )
+            )
+            self.assertLessEqual(seconds, budget)
+            for lazy in ('numpy', 'flask_mako', 'mako', 'paste.script'):
+                self.assertNotIn(lazy, modules)
+
+
+class PresenceAnalyzerStressTestCase(unittest.TestCase):
+    """
+    Concurrency tests of data loading and caches under file rewrites.
+    """
+    versions = 30
+    workers = 16
+    endpoints = (
+        'users',
+        'users?has_data=1',
+        'users?q=A&limit=2',
+        'months',
+        'mean_time_weekday/10',
+        'presence_weekday/10',
+        'presence_start_end/10',
+        'podium/11',
+        'five_top/9,2013',
+        'rank/10/2013/9',
+        'weekly/10',
+        'overtime/10',
+        'weekly_team',
+        'cube?group_by=user,month',
+        'changes?since=1',
+    )
+
+    def setUp(self):
+        """
+        Before each test, copy test data into dataset rewritten by test.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.current = os.path.join(self.directory, 'current')
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            self.base_csv = csvfile.read()
+        with open(TEST_XML_DATA, 'rb') as xmlfile:
+            self.base_xml = xmlfile.read()
+        self.mtime = int(time.time()) - 10 * self.versions
+        self.write_version(0)
+        main.app.config.update(
+            {
+                'XML_DATA': TEST_XML_DATA,
+                'DATA_CSV': TEST_DATA_CSV,
+                'DATA_MAX_AGE': 0.05,
+                'DATASETS': {
+                    'stress': {
+                        'DATA_CSV': os.path.join(self.current, 'data.csv'),
+                        'XML_DATA': os.path.join(self.current, 'users.xml'),
+                    },
+                },
+            }
+        )
+        self.loads = []
+        self.published = []
+        parse_users = utils.parse_users
+
+        def counted_parse_users(path):
+            """
+            Counts loads of stress dataset.
+            """
+            if path.startswith(self.current):
+                self.loads.append(path)
+            return parse_users(path)
+
+        def listener(dataset, version):
+            """
+            Records published versions of stress dataset.
+            """
+            if dataset == 'stress':
+                self.published.append(version)
+
+        self.parse_users = parse_users
+        utils.parse_users = counted_parse_users
+        self.listener = listener
+        utils.version_listeners.append(listener)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.parse_users = self.parse_users
+        utils.version_listeners.remove(self.listener)
+        utils.evict_dataset('stress')
+        main.app.config.pop('DATASETS')
+        main.app.config.pop('DATA_MAX_AGE')
+        shutil.rmtree(self.directory)
+
+    def write_version(self, version):
+        """
+        Writes files of version into new directory and atomically points
+        current link at it. CSV has version extra rows of user 10, one per
+        day from 2014-01-01, and a row of user 1000 + version, who is
+        the only user added to XML.
+        """
+        first = datetime.date(2014, 1, 1)
+        rows = ''.join(
+            '10,{},09:00:00,17:00:00\n'.format(
+                first + datetime.timedelta(days=day)
+            )
+            for day in xrange(version)
+        )
+        rows += '{},2014-01-01,09:00:00,17:00:00\n'.format(1000 + version)
+        user = (
+            '<users>\n        <user id="{0}">\n'
+            '            <avatar>/api/images/users/{0}</avatar>\n'
+            '            <name>Stress {0}</name>\n        </user>'
+        ).format(1000 + version)
+        directory = os.path.join(self.directory, str(version))
+        os.mkdir(directory)
+        files = (
+            ('data.csv', self.base_csv + rows.encode('utf-8')),
+            (
+                'users.xml',
+                self.base_xml.replace(b'<users>', user.encode('utf-8'), 1)
+            ),
+        )
+        for name, content in files:
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as output:
+                output.write(content)
+            mtime = self.mtime + 10 * version
+            os.utime(path, (mtime, mtime))
+        link = self.current + '.tmp'
+        os.symlink(directory, link)
+        os.rename(link, self.current)
+
+    def stress_data(self):
+        """
+        Extra users of XML and extra rows of user 10 read from one
+        snapshot of stress dataset.
+        """
+        with main.app.app_context():
+            utils.g.dataset = 'stress'
+            data = utils.get_data()
+            users = utils.xml_translator()
+            return (
+                [user_id for user_id in users if user_id >= 1000],
+                len(data[10]) - 3
+            )
+
+    def test_concurrent_reloads(self):
+        """
+        Test responses never carrying partial, mixed or older data,
+        at most one load per written version and tail latency within
+        STRESS_P99_SECONDS while files are rewritten and reloaded
+        from many threads.
+        """
+        done = threading.Event()
+        errors = []
+        latencies = []
+
+        def guarded(target, *args):
+            """
+            Runs target, recording its exception instead of losing it.
+            """
+            try:
+                target(*args)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(('exception', repr(error)))
+
+        def writer():
+            """
+            Writes every version, then lets readers see the last one.
+            """
+            for version in xrange(1, self.versions + 1):
+                time.sleep(0.02)
+                self.write_version(version)
+            time.sleep(0.1)
+            done.set()
+
+        def refresher():
+            """
+            Reloads changed datasets, as the reload thread does.
+            """
+            while not done.is_set():
+                utils.refresh_datasets()
+                time.sleep(0.005)
+
+        def reader(number):
+            """
+            Requests endpoints in turn, checking versions of data
+            in responses never go down. Users with data are only those
+            of XML with CSV rows, so a response mixing XML and CSV of
+            different versions lists no extra user.
+            """
+            client = main.app.test_client()
+            seen = {'weekly/10': 0, 'users?has_data=1': 0}
+            step = number
+            while not done.is_set():
+                endpoint = self.endpoints[step % len(self.endpoints)]
+                step += 1
+                url = '/api/v1/stress/' + endpoint
+                start = time.time()
+                response = client.get(url)
+                latencies.append(time.time() - start)
+                if response.status_code != 200:
+                    errors.append((url, response.status_code))
+                    continue
+                data = json.loads(response.data)
+                if endpoint == 'weekly/10':
+                    version = sum(week['days'] for week in data) - 3
+                elif endpoint == 'users?has_data=1':
+                    extra = [
+                        user['user_id'] for user in data
+                        if user['user_id'] >= 1000
+                    ]
+                    if len(extra) != 1:
+                        errors.append((url, 'mixed', extra))
+                        continue
+                    version = extra[0] - 1000
+                else:
+                    continue
+                if not seen[endpoint] <= version <= self.versions:
+                    errors.append((url, seen[endpoint], version))
+                seen[endpoint] = version
+
+        threads = [threading.Thread(target=guarded, args=(writer,))]
+        threads.extend(
+            threading.Thread(target=guarded, args=(refresher,))
+            for _ in xrange(2)
+        )
+        threads.extend(
+            threading.Thread(target=guarded, args=(reader, number))
+            for number in xrange(self.workers)
+        )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        utils.refresh_datasets()
+        self.assertEqual(
+            self.stress_data(), ([1000 + self.versions], self.versions)
+        )
+        self.assertLessEqual(len(self.loads), self.versions + 1)
+        self.assertEqual(
+            self.published,
+            range(self.published[0], self.published[0] + len(self.published))
+        )
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        self.assertLessEqual(
+            p99, float(os.environ.get('STRESS_P99_SECONDS', 1.0))
+        )
+
 
 def suite():
     """
@@ -599,6 +2416,11 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAnomaliesTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerEventsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStartupTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStressTestCase))
     return base_suite
 
 
@@ -2,70 +2,1023 @@
 """
 Helper functions used in views.
 """
+import bisect
 import calendar
-import csv
+import glob
+import hashlib
 import logging
+import os
+import sys
 import time
 import threading
+from array import array
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
-
-import xml.etree.ElementTree as ET
 from json import dumps
-from flask import Response
 
+from flask import (
+    Response,
+    abort,
+    g,
+    has_app_context,
+    has_request_context,
+    request
+)
+
+from presence_analyzer.cache import (
+    DictBackend,
+    FileBackend,
+    MemcachedBackend
+)
 from presence_analyzer.main import app
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 storage_cache = {}
+shard_cache = {}
+snapshots = {}
+last_used = {}
+reload_locks = {}
+data_versions = {}
+data_signatures = {}
+content_digests = {}
+version_listeners = []
+in_flight = {}
+cache_backends = {}
+worker_pools = {}
+optional_modules = {}
+MISSING = object()
+trace_state = threading.local()  # pylint: disable=invalid-name
+allocation_snapshots = {}
+in_flight_lock = threading.Lock()
+responses_lock = threading.Lock()
 lock = threading.Lock()
+COLUMNS_TYPE = 'application/vnd.presence-analyzer.columns+json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+COMPRESSION_MAGIC = (
+    ('gzip', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+)
 
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+    Function may return (result, headers) tuple to add response headers.
+    Clients accepting COLUMNS_TYPE get the result in columnar layout,
+    those accepting one of MSGPACK_TYPES get it as MessagePack.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        result = function(*args, **kwargs)
+        headers = None
+        if isinstance(result, tuple):
+            result, headers = result
+        mimetype = response_type()
+        with Span('json_encode'):
+            if mimetype in MSGPACK_TYPES:
+                body = msgpack_module().packb(result, use_bin_type=False)
+            elif mimetype == COLUMNS_TYPE:
+                body = dumps(columns(result), separators=(',', ':'))
+            else:
+                body = dumps(result)
+        response = Response(body, mimetype=mimetype, headers=headers)
+        response.vary.add('Accept')
+        return response
+    return inner
+
+
+def response_type():
+    """
+    Media type of API response preferred in Accept header of request,
+    JSON by default and when MessagePack is not importable.
+    """
+    offered = ['application/json', COLUMNS_TYPE]
+    if msgpack_module() is not None:
+        offered.extend(MSGPACK_TYPES)
+    if not has_request_context():
+        return offered[0]
+    return request.accept_mimetypes.best_match(offered, offered[0])
+
+
+def msgpack_module():
+    """
+    Returns msgpack module or None. Import is attempted once, failed
+    imports aren't cached by Python 2 and would search sys.path on every
+    request.
+    """
+    try:
+        return optional_modules['msgpack']
+    except KeyError:
+        pass
+    try:
+        import msgpack  # pylint: disable=import-error
+    except ImportError:
+        msgpack = None
+    return optional_modules.setdefault('msgpack', msgpack)
+
+
+def columns(result):
+    """
+    Columnar layout of result: lists of equally long lists or tuples
+    become lists of columns and lists of dicts with the same keys become
+    dicts of columns, also inside dicts. Other values are kept.
+    For example [('Mon', 1), ('Tue', 2)] becomes [['Mon', 'Tue'], [1, 2]].
+    """
+    if isinstance(result, dict):
+        return dict(
+            (key, columns(value)) for key, value in result.iteritems()
         )
+    if not isinstance(result, list) or not result:
+        return result
+    first = result[0]
+    if isinstance(first, (list, tuple)):
+        size = len(first)
+        if all(
+                isinstance(row, (list, tuple)) and len(row) == size
+                for row in result):
+            return [list(column) for column in zip(*result)]
+    elif isinstance(first, dict):
+        keys = first.viewkeys()
+        if all(
+                isinstance(row, dict) and row.viewkeys() == keys
+                for row in result):
+            return dict((key, [row[key] for row in result]) for key in keys)
+    return result
+
+
+class Span(object):
+    """
+    Times block as named span of request traced by start_trace.
+    Outside of traced requests it only reads one thread local.
+    """
+    __slots__ = ('name', 'spans', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = None
+        self.started = None
+
+    def __enter__(self):
+        self.spans = getattr(trace_state, 'spans', None)
+        if self.spans is not None:
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.spans is not None:
+            self.spans.append((self.name, time.time() - self.started))
+
+
+def traced(function):
+    """
+    Times calls of function as spans named after it.
+    """
+    name = function.__name__
+
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        spans = getattr(trace_state, 'spans', None)
+        if spans is None:
+            return function(*args, **kwargs)
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            spans.append((name, time.time() - started))
     return inner
 
 
-def memoize(storage=storage_cache, age_cache=0):
+def start_trace():
+    """
+    Starts collecting spans of current thread.
+    """
+    trace_state.spans = []
+    trace_state.started = time.time()
+
+
+def finish_trace():
+    """
+    Stops collecting spans of current thread.
+    Returns traced seconds and seconds and calls of every span name,
+    None when nothing was traced.
+    """
+    spans = getattr(trace_state, 'spans', None)
+    if spans is None:
+        return None
+    trace_state.spans = None
+    breakdown = OrderedDict()
+    for name, seconds in spans:
+        total = breakdown.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        total['seconds'] += seconds
+        total['calls'] += 1
+    return time.time() - trace_state.started, breakdown
+
+
+def shed_load():
+    """
+    Rejects request with 503 Service Unavailable.
+    """
+    abort(
+        Response(
+            dumps('service unavailable'),
+            status=503,
+            mimetype='application/json',
+            headers={'Retry-After': '1'}
+        )
+    )
+
+
+def admission(limit=4, queue=16):
+    """
+    Runs at most limit calls at once, queues at most queue callers
+    for ADMISSION_TIMEOUT seconds and sheds the others with 503.
+    Limits can be overridden per function in ADMISSION_LIMITS, e.g.
+    ADMISSION_LIMITS = {'five_top': (2, 8)}.
+    """
+    def decorator(function):
+        """
+        Wraps function with admission control.
+        """
+        state = {
+            'condition': threading.Condition(),
+            'running': 0,
+            'waiting': 0,
+        }
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            max_running, max_waiting = app.config.get(
+                'ADMISSION_LIMITS', {}
+            ).get(function.__name__, (limit, queue))
+            condition = state['condition']
+            with condition:
+                if state['running'] >= max_running:
+                    if state['waiting'] >= max_waiting:
+                        shed_load()
+                    deadline = (
+                        time.time() + app.config.get('ADMISSION_TIMEOUT', 10)
+                    )
+                    state['waiting'] += 1
+                    try:
+                        while state['running'] >= max_running:
+                            if deadline <= time.time():
+                                shed_load()
+                            condition.wait(deadline - time.time())
+                    finally:
+                        state['waiting'] -= 1
+                state['running'] += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with condition:
+                    state['running'] -= 1
+                    condition.notify()
+        inner.admission = state
+        return inner
+    return decorator
+
+
+def coalesce(function):
+    """
+    Shares result of a call among identical concurrent calls.
+    Calls are identical when they have the same arguments, query string,
+    dataset and data version.
+    Errors are raised in every call with traceback of the failed one.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        key = (
+            function.__name__,
+            args,
+            tuple(sorted(kwargs.items())),
+            current_dataset(),
+            get_snapshot().version,
+            request.query_string if has_request_context() else None,
+        )
+        with in_flight_lock:
+            call = in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = in_flight[key] = {
+                    'done': threading.Event(),
+                    'result': None,
+                    'error': None,
+                }
+        if leader:
+            try:
+                call['result'] = function(*args, **kwargs)
+            except Exception:
+                call['error'] = sys.exc_info()
+                raise
+            finally:
+                with in_flight_lock:
+                    del in_flight[key]
+                call['done'].set()
+            return call['result']
+        call['done'].wait()
+        if call['error'] is not None:
+            error_type, error, traceback = call['error']
+            raise error_type, error, traceback
+        return call['result']
+    return inner
+
+
+def memoize(storage=None, age_cache=0):
     """
     Caching function.
+    Values are kept in storage dict or backend, in backend configured
+    by CACHE_BACKEND by default.
     """
     def _memoize(function):
         with lock:
             def __memoize(*args, **kw):
-                key = function.__name__
-                try:
-                    expired = (
-                        age_cache != 0 and
-                        (storage[key]['expire_time'] + age_cache) <
-                        time.time())
-                except KeyError:
-                    expired = True
-                if not expired:
-                    return storage[key]['values']
-                storage[key] = {
-                    'expire_time': time.time(),
-                    'values': function(*args, **kw)
-                }
-                return storage[key]['values']
+                backend = storage
+                if backend is None:
+                    backend = cache_backend()
+                elif isinstance(backend, dict):
+                    backend = DictBackend(backend)
+                key = (current_dataset(), function.__name__)
+                values = backend.get(key, MISSING)
+                if values is MISSING:
+                    started = time.time()
+                    values = function(*args, **kw)
+                    if not age_cache:
+                        backend.set(key, values)
+                    elif started + age_cache > time.time():
+                        backend.set(
+                            key, values, started + age_cache - time.time()
+                        )
+                return values
             return __memoize
     return _memoize
 
 
-@memoize(age_cache=600)
+def cache_backend():
+    """
+    Cache backend named by CACHE_BACKEND: 'dict' keeps values in this
+    process, 'file' in CACHE_DIR and 'memcached' on CACHE_SERVERS,
+    e.g. CACHE_SERVERS = ['10.0.0.5:11211', '10.0.0.6:11211'].
+    Defaults to 'file' when CACHE_DIR is set, to 'dict' otherwise.
+    """
+    name = app.config.get('CACHE_BACKEND') or (
+        'file' if app.config.get('CACHE_DIR') else 'dict'
+    )
+    settings = (
+        name,
+        app.config.get('CACHE_DIR'),
+        tuple(app.config.get('CACHE_SERVERS', ())),
+    )
+    backend = cache_backends.get(settings)
+    if backend is None:
+        if name == 'dict':
+            backend = DictBackend(storage_cache)
+        elif name == 'file':
+            backend = FileBackend(app.config['CACHE_DIR'])
+        elif name == 'memcached':
+            backend = MemcachedBackend(
+                app.config['CACHE_SERVERS'],
+                app.config.get('CACHE_TIMEOUT', 1.0)
+            )
+        else:
+            raise ValueError('Unknown CACHE_BACKEND {}'.format(name))
+        backend = cache_backends.setdefault(settings, backend)
+    return backend
+
+
+def data_index(function):
+    """
+    Caches structure derived from presence data in the data snapshot.
+    """
+    @wraps(function)
+    def inner():
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        return get_snapshot().index(function.__name__, function)
+    return inner
+
+
+class Snapshot(object):
+    """
+    Immutable presence and user data of one dataset.
+    Derived indexes are built lazily from the data and stored with
+    dict.setdefault, so concurrent builders agree on one result.
+    Changes is a tuple of (version, changed rows, rows removed) entries
+    of recent versions. Size is taken by the data, users_size by users,
+    shards_size by cached shards beside the data and index_size
+    by indexes added so far. Versions of one epoch
+    continue each other, epoch changes when dataset is loaded anew,
+    e.g. after restart.
+    """
+    __slots__ = (
+        'data', 'users', 'paths', 'version', 'changes', 'size', 'loaded',
+        'indexes', 'responses', 'signature', 'users_size', 'index_size',
+        'digest', 'epoch', 'shards_size',
+    )
+
+    def __init__(self, data, users, paths, version=1, changes=(),
+                 signature=(), digest=None, epoch=None):
+        self.data = data
+        self.users = users
+        self.paths = paths
+        self.version = version
+        self.changes = changes
+        self.size = data_size(data)
+        self.loaded = time.time()
+        self.indexes = {}
+        self.responses = OrderedDict()
+        self.signature = signature
+        self.users_size = object_size(users)
+        self.index_size = 0
+        self.digest = digest
+        self.epoch = epoch or os.urandom(16).encode('hex')
+        self.shards_size = shards_size(data, paths)
+
+    def renewed(self, paths, signature=()):
+        """
+        Copy of unchanged snapshot with new load time, sharing indexes.
+        """
+        snapshot = Snapshot.__new__(Snapshot)
+        for name in self.__slots__:
+            setattr(snapshot, name, getattr(self, name))
+        snapshot.paths = paths
+        snapshot.loaded = time.time()
+        snapshot.signature = signature
+        snapshot.shards_size = shards_size(self.data, paths)
+        return snapshot
+
+    def index(self, name, builder):
+        """
+        Returns index built from the data by builder.
+        With a shared cache backend, indexes are also kept there under
+        the digest of data files content, so they are reused after
+        restart and by other nodes reading copies of the same files.
+        """
+        try:
+            return self.indexes[name]
+        except KeyError:
+            pass
+        backend = cache_backend()
+        if not backend.shared or not self.digest:
+            value = builder(self.data)
+        else:
+            key = ('index', code_signature(), self.digest, name)
+            value = backend.get(key, MISSING)
+            if value is MISSING:
+                value = builder(self.data)
+                backend.set(key, value)
+        stored = self.indexes.setdefault(name, value)
+        if stored is value:
+            self.index_size += object_size(value)
+            evict_datasets(current_dataset())
+        return stored
+
+    def memory(self):
+        """
+        Approximates bytes taken by data, users, shards, indexes
+        and responses.
+        """
+        with responses_lock:
+            responses = self.responses.items()
+        return (
+            self.size + self.users_size + self.shards_size +
+            self.index_size + object_size(responses)
+        )
+
+
+def cached_response(*arguments):
+    """
+    Keeps encoded responses of wrapped view in data snapshot, keyed by
+    request path, values of given query arguments, in given order,
+    and negotiated media type, so other query arguments add no entries.
+    Snapshot keeps RESPONSE_CACHE_SIZE most recently used responses.
+    With a shared cache backend, responses are also kept there under
+    the digest of data files content, so they survive restart.
+    """
+    def decorator(function):
+        """
+        Caches responses of function.
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            key = (
+                request.path,
+                tuple(request.args.get(name) for name in arguments),
+                response_type(),
+            )
+            snapshot = get_snapshot()
+            responses = snapshot.responses
+            with responses_lock:
+                cached = responses.pop(key, None)
+                if cached is not None:
+                    responses[key] = cached
+            if cached is None:
+                backend = cache_backend()
+                stored = None
+                if backend.shared and snapshot.digest:
+                    stored = (
+                        'response', code_signature(), snapshot.digest
+                    ) + key
+                    cached = backend.get(stored)
+                if cached is None:
+                    response = function(*args, **kwargs)
+                    cached = (
+                        response.get_data(),
+                        response.status_code,
+                        response.headers.to_wsgi_list(),
+                    )
+                    if stored is not None:
+                        backend.set(stored, cached)
+                with responses_lock:
+                    responses[key] = cached
+                    while len(responses) > app.config.get(
+                            'RESPONSE_CACHE_SIZE', 256):
+                        responses.popitem(last=False)
+                evict_datasets(current_dataset())
+            body, status, headers = cached
+            return Response(body, status=status, headers=headers)
+        return inner
+    return decorator
+
+
+@memoize(storage=storage_cache)
+def code_signature():
+    """
+    Digest of package sources, so structures cached in shared backend
+    by other code are not reused after deploy.
+    """
+    digest = hashlib.sha1()
+    pattern = os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def current_dataset():
+    """
+    Name of dataset selected for current request, None for default one.
+    """
+    if has_app_context():
+        return getattr(g, 'dataset', None)
+    return None
+
+
+def dataset_config(key):
+    """
+    Returns config value of current dataset.
+    Named datasets are configured in DATASETS, e.g.
+    DATASETS = {
+        'office': {'DATA_CSV': '...', 'XML_DATA': '...'},
+    }
+    """
+    dataset = current_dataset()
+    if dataset is None:
+        return app.config[key]
+    return app.config['DATASETS'][dataset][key]
+
+
+def data_size(data):
+    """
+    Approximates memory taken by presence data in bytes.
+    """
+    size = sys.getsizeof(data)
+    for dates in data.itervalues():
+        size += sys.getsizeof(dates)
+        for date, times in dates.iteritems():
+            size += (
+                sys.getsizeof(date) + sys.getsizeof(times) +
+                sys.getsizeof(times['start']) + sys.getsizeof(times['end'])
+            )
+    return size
+
+
+def shards_size(data, paths):
+    """
+    Approximates memory taken by cached shards of paths in bytes, beside
+    data merged from them. Rows shared with data aren't counted.
+    """
+    size = 0
+    for path in paths:
+        shard = shard_cache.get(path, (None, None))[1]
+        if shard is None or shard is data:
+            continue
+        size += sys.getsizeof(shard)
+        for user_id, dates in shard.iteritems():
+            size += sys.getsizeof(dates)
+            merged = data.get(user_id, {})
+            for date, times in dates.iteritems():
+                if merged.get(date) is not times:
+                    size += (
+                        sys.getsizeof(date) + sys.getsizeof(times) +
+                        sys.getsizeof(times['start']) +
+                        sys.getsizeof(times['end'])
+                    )
+    return size
+
+
+def get_snapshot():
+    """
+    Returns data snapshot of current dataset.
+    The snapshot is taken once per request, so every view sees data
+    of a single load even when a reload is published meanwhile.
+    """
+    if not has_app_context():
+        return published_snapshot()
+    snapshot = getattr(g, 'snapshot', None)
+    if snapshot is None:
+        snapshot = g.snapshot = published_snapshot()
+    return snapshot
+
+
+def published_snapshot():
+    """
+    Returns published snapshot of current dataset, reloading old one.
+    Readers only wait when nothing was loaded yet; an expired snapshot
+    is rebuilt by one thread while the others keep reading it.
+    """
+    dataset = current_dataset()
+    last_used[dataset] = time.time()
+    snapshot = snapshots.get(dataset)
+    if snapshot is None:
+        with reload_lock(dataset):
+            snapshot = snapshots.get(dataset)
+            if snapshot is None:
+                snapshot = publish_snapshot(dataset)
+    elif snapshot.loaded + app.config.get('DATA_MAX_AGE', 600) < time.time():
+        dataset_lock = reload_lock(dataset)
+        if dataset_lock.acquire(False):
+            try:
+                snapshot = publish_snapshot(dataset)
+            finally:
+                dataset_lock.release()
+    return snapshot
+
+
+def reload_lock(dataset):
+    """
+    Lock held by the thread building snapshot of given dataset.
+    """
+    return reload_locks.setdefault(dataset, threading.Lock())
+
+
+def publish_snapshot(dataset):
+    """
+    Builds new snapshot of dataset and publishes it in one assignment.
+    Files whose signature did not change since previous snapshot are
+    not loaded again.
+    """
+    previous = snapshots.get(dataset)
+    signature = data_signature()
+    if previous is not None and signature == previous.signature:
+        snapshot = previous.renewed(previous.paths, signature)
+    else:
+        snapshot = load_snapshot(previous, signature)
+    cache_backend().prune(app.config.get('CACHE_MAX_AGE', 7 * 24 * 3600))
+    data_signatures[dataset] = snapshot.signature
+    data_versions[dataset] = snapshot.version
+    snapshots[dataset] = snapshot
+    evict_datasets(dataset)
+    if previous is None or snapshot.version != previous.version:
+        for listener in version_listeners:
+            listener(dataset, snapshot.version)
+    return snapshot
+
+
+def load_snapshot(previous, signature):
+    """
+    Loads files of current dataset into snapshot following previous one.
+    Loading is repeated, up to DATA_LOAD_ATTEMPTS times, while files
+    change underneath it, so snapshot never mixes files of different
+    signatures. When they keep changing, previous snapshot is kept.
+    Content digest, read from every byte of the files, is only taken
+    for shared cache backends keeping indexes under it.
+    """
+    dataset = current_dataset()
+    attempts = app.config.get('DATA_LOAD_ATTEMPTS', 3)
+    while True:
+        paths = data_files(dataset_config('DATA_CSV'))
+        with Span('csv_load'):
+            data = merge_shards(
+                load_shards(paths, previous.paths if previous else ())
+            )
+        with Span('xml_parse'):
+            users = parse_users(dataset_config('XML_DATA'))
+        digest = None
+        if cache_backend().shared:
+            digest = content_digest(paths + [dataset_config('XML_DATA')])
+        attempts -= 1
+        current = data_signature()
+        if current == signature:
+            break
+        if attempts <= 0 and previous is not None:
+            log.warning('Files of dataset %s keep changing', dataset)
+            return previous
+        if attempts <= 0:
+            break
+        log.info('Files of dataset %s changed while loading', dataset)
+        signature = current
+    if previous is None:
+        version = data_versions.get(dataset, 0) + 1
+        return Snapshot(
+            data, users, paths, version, signature=signature, digest=digest
+        )
+    changed, removed = data_changes(previous.data, data)
+    if not changed and not removed and users == previous.users:
+        return previous.renewed(paths, signature)
+    version = previous.version + 1
+    changes = previous.changes + ((version, changed, removed),)
+    return Snapshot(
+        data,
+        users,
+        paths,
+        version,
+        changes[-app.config.get('CHANGE_LOG_VERSIONS', 50):],
+        signature,
+        digest,
+        previous.epoch
+    )
+
+
+def data_signature():
+    """
+    Signature of CSV and XML files of current dataset.
+    """
+    paths = data_files(dataset_config('DATA_CSV'))
+    paths.append(dataset_config('XML_DATA'))
+    return tuple((path, file_signature(path)) for path in paths)
+
+
+def content_digest(paths):
+    """
+    Digest of content of files, the same on every node holding copies
+    of them. Digests of files are reused until their signature changes.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        signature = file_signature(path)
+        cached = content_digests.get(path)
+        if cached is None or cached[0] != signature:
+            file_digest = hashlib.sha1()
+            with open(path, 'rb') as content:
+                for chunk in iter(lambda: content.read(1024 * 1024), ''):
+                    file_digest.update(chunk)
+            cached = content_digests[path] = (
+                signature, file_digest.hexdigest()
+            )
+        digest.update(cached[1])
+    return digest.hexdigest()
+
+
+def refresh_datasets():
+    """
+    Reloads loaded datasets whose files changed since last load.
+    """
+    for dataset in list(snapshots):
+        with app.app_context():
+            g.dataset = dataset
+            try:
+                changed = data_signature() != data_signatures.get(dataset)
+            except OSError:
+                log.warning('Cannot read files of %s', dataset, exc_info=True)
+                continue
+            dataset_lock = reload_lock(dataset)
+            if changed and dataset_lock.acquire(False):
+                try:
+                    publish_snapshot(dataset)
+                finally:
+                    dataset_lock.release()
+
+
+def data_changes(previous, data):
+    """
+    Lists (user_id, date) rows added or changed since previous data
+    and tells whether any rows were removed.
+    """
+    changed = []
+    for user_id, dates in data.iteritems():
+        old = previous.get(user_id, {})
+        changed.extend(
+            (user_id, date) for date, times in dates.iteritems()
+            if old.get(date) != times
+        )
+    removed = any(
+        date not in data.get(user_id, ())
+        for user_id, dates in previous.iteritems()
+        for date in dates
+    )
+    return sorted(changed), removed
+
+
+def changes_since(version, epoch=None):
+    """
+    Rows of presence data changed after given version of given epoch.
+    Returns None when the change log does not reach back to version,
+    version is of another epoch or ahead of current one, e.g. from
+    before restart, or rows were removed meanwhile, so a full resync
+    is needed.
+    """
+    snapshot = get_snapshot()
+    if epoch is not None and epoch != snapshot.epoch:
+        return None
+    if version is not None and version > snapshot.version:
+        return None
+    if version == snapshot.version:
+        return []
+    entries = [entry for entry in snapshot.changes if entry[0] > version]
+    if (version is None or not entries or
+            entries[0][0] != version + 1 or
+            any(removed for _, _, removed in entries)):
+        return None
+    rows = sorted(set(row for _, changed, _ in entries for row in changed))
+    return [
+        {
+            'user_id': user_id,
+            'date': date.isoformat(),
+            'start': snapshot.data[user_id][date]['start'].isoformat(),
+            'end': snapshot.data[user_id][date]['end'].isoformat(),
+        }
+        for user_id, date in rows
+    ]
+
+
+def evict_datasets(current):
+    """
+    Evicts least recently used datasets exceeding DATASET_MEMORY_BUDGET,
+    counting their data, users, shards, indexes and cached responses.
+    """
+    budget = app.config.get('DATASET_MEMORY_BUDGET')
+    if not budget:
+        return
+    for dataset in sorted(snapshots, key=lambda name: last_used.get(name)):
+        if sum(
+                snapshot.memory()
+                for snapshot in snapshots.values()) <= budget:
+            break
+        if dataset != current:
+            evict_dataset(dataset)
+
+
+def evict_dataset(dataset):
+    """
+    Drops snapshot and all cached data of given dataset.
+    """
+    snapshot = snapshots.pop(dataset, None)
+    data_signatures.pop(dataset, None)
+    for path in snapshot.paths if snapshot else ():
+        shard_cache.pop(path, None)
+        content_digests.pop(path, None)
+    for key in storage_cache.keys():
+        if isinstance(key, tuple) and key[0] == dataset:
+            storage_cache.pop(key, None)
+    log.info('Evicted dataset %s', dataset)
+
+
+def object_size(value):
+    """
+    Approximates memory taken by value and objects it refers to
+    in bytes, counting every object once. Numpy views are counted
+    with the array owning their data, so its buffer is counted once.
+    """
+    numpy = sys.modules.get('numpy')
+    seen = set()
+    stack = [value]
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.iterkeys())
+            stack.extend(item.itervalues())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif numpy is not None and isinstance(item, numpy.ndarray):
+            if item.base is not None:
+                stack.append(item.base)
+    return size
+
+
+def memory_report():
+    """
+    Approximate sizes in bytes of loaded datasets, their derived indexes
+    and cache entries, biggest first. Objects shared between entries,
+    like shard rows merged into dataset, are counted in each of them.
+    """
+    def by_size(entries):
+        """
+        Sorts entries by size, biggest first.
+        """
+        return sorted(entries, key=lambda entry: entry['size'], reverse=True)
+
+    datasets = []
+    for dataset, snapshot in sorted(snapshots.items()):
+        indexes = by_size(
+            {'name': repr(name), 'size': object_size(index)}
+            for name, index in snapshot.indexes.items()
+        )
+        with responses_lock:
+            responses = snapshot.responses.items()
+        responses = object_size(responses)
+        datasets.append({
+            'dataset': dataset,
+            'version': snapshot.version,
+            'data': snapshot.size,
+            'users': object_size(snapshot.users),
+            'shards': snapshot.shards_size,
+            'indexes': indexes,
+            'responses': responses,
+            'size': (
+                snapshot.size + object_size(snapshot.users) +
+                snapshot.shards_size + responses +
+                sum(index['size'] for index in indexes)
+            ),
+        })
+    return {
+        'datasets': datasets,
+        'caches': {
+            'memoize': by_size(
+                {'key': repr(key), 'size': object_size(entry)}
+                for key, entry in storage_cache.items()
+            ),
+            'shards': by_size(
+                {'path': path, 'size': object_size(shard)}
+                for path, (_, shard) in shard_cache.items()
+            ),
+        },
+    }
+
+
+def allocations(action, limit=20, frames=1):
+    """
+    Controls tracemalloc allocation tracing: 'start' begins tracing with
+    frames per traceback, 'snapshot' keeps baseline and lists biggest
+    allocations, 'diff' lists biggest changes since baseline and 'stop'
+    ends tracing. Traces are grouped by presence_analyzer source line.
+    Returns None when tracemalloc isn't available (Python 2).
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    if action == 'start':
+        allocation_snapshots.clear()
+        tracemalloc.start(frames)
+    elif action == 'stop':
+        allocation_snapshots.clear()
+        tracemalloc.stop()
+    report = {'tracing': tracemalloc.is_tracing()}
+    if action in ('snapshot', 'diff') and report['tracing']:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(
+                True,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), '*')
+            ),
+        ])
+        if action == 'snapshot' or 'baseline' not in allocation_snapshots:
+            allocation_snapshots['baseline'] = snapshot
+            statistics = snapshot.statistics('lineno')
+        else:
+            statistics = snapshot.compare_to(
+                allocation_snapshots['baseline'], 'lineno'
+            )
+        report['allocations'] = [
+            {
+                'file': os.path.basename(stat.traceback[0].filename),
+                'line': stat.traceback[0].lineno,
+                'size': stat.size,
+                'count': stat.count,
+                'size_diff': getattr(stat, 'size_diff', stat.size),
+                'count_diff': getattr(stat, 'count_diff', stat.count),
+            }
+            for stat in statistics[:limit]
+        ]
+    if report['tracing']:
+        report['traced'], report['peak'] = tracemalloc.get_traced_memory()
+    return report
+
+
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -82,24 +1035,296 @@ def get_data():
             },
         }
     }
+    DATA_CSV may point to a single file, a directory of CSV files
+    or a glob pattern; every matching file is parsed as a shard.
+    """
+    return get_snapshot().data
+
+
+def data_files(path):
+    """
+    Lists CSV shards behind DATA_CSV path, directory or glob pattern.
+    Directories are searched for plain and compressed CSV files.
+    """
+    if os.path.isdir(path):
+        return sorted(
+            name
+            for extension in [''] + sorted(COMPRESSION_EXTENSIONS)
+            for name in glob.glob(os.path.join(path, '*.csv' + extension))
+        )
+    if glob.has_magic(path):
+        return sorted(glob.glob(path))
+    return [path]
+
+
+def compression(path):
+    """
+    Compression of file detected by extension or magic bytes,
+    None for plain files.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in COMPRESSION_EXTENSIONS:
+        return COMPRESSION_EXTENSIONS[extension]
+    with open(path, 'rb') as stream:
+        head = stream.read(6)
+    for kind, magic in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def open_compressed(path, kind):
+    """
+    Opens compressed file for streaming decompression.
+    """
+    if kind == 'gzip':
+        import gzip
+        return gzip.open(path, 'rb')
+    if kind == 'bz2':
+        import bz2
+        return bz2.BZ2File(path, 'rb')
+    lzma = lzma_module()
+    if lzma is None:
+        raise IOError(
+            '{} is xz compressed, install backports.lzma'.format(path)
+        )
+    return lzma.LZMAFile(path, 'rb')
+
+
+def lzma_module():
+    """
+    Returns lzma module, from backports.lzma on Python 2, or None.
+    """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma  # pylint: disable=import-error
+        except ImportError:
+            return None
+    return lzma
+
+
+def file_signature(path):
+    """
+    Returns signature which changes whenever the file is modified.
+    """
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+def parse_csv(path):
+    """
+    Parses a single presence CSV file into user_id -> date mapping.
+    """
+    task = (path, 0, None if compression(path) else os.path.getsize(path))
+    return collect_ranges([parse_range(task)])
+
+
+def split_ranges(path, chunk_size):
+    """
+    Splits file into newline-aligned (path, start, end) byte ranges.
+    Compressed files can't be seeked into, they are streamed whole
+    as a single (path, 0, None) range.
+    """
+    if compression(path):
+        return [(path, 0, None)]
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, 'rb') as csvfile:
+        while start < size:
+            csvfile.seek(start + chunk_size)
+            csvfile.readline()
+            end = min(csvfile.tell(), size)
+            ranges.append((path, start, end))
+            start = end
+    return ranges or [(path, 0, 0)]
+
+
+def parse_range(task):
+    """
+    Parses byte range of presence CSV file into compact columns.
+    Returns user ids, date ordinals, start and end seconds arrays,
+    number of lines read and (line, error) pairs of malformed lines.
+    Range without end is a compressed file decompressed while parsing.
+    """
+    path, begin, finish = task
+    if finish is None:
+        with open_compressed(path, compression(path)) as csvfile:
+            return parse_lines(csvfile)
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(begin)
+        return parse_lines(csvfile.read(finish - begin).splitlines(True))
+
+
+def parse_lines(lines):
+    """
+    Parses presence CSV lines into compact columns.
+    """
+    import csv
+    columns = (array('l'), array('l'), array('l'), array('l'))
+    problems = []
+    reader = csv.reader(lines, delimiter=',')
+    for i, row in enumerate(reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError) as error:
+            problems.append((i, str(error)))
+            continue
+
+        columns[0].append(user_id)
+        columns[1].append(date.toordinal())
+        columns[2].append(seconds_since_midnight(start))
+        columns[3].append(seconds_since_midnight(end))
+    return columns, reader.line_num, problems
+
+
+def collect_ranges(results):
+    """
+    Merges parsed byte ranges of one file into user_id -> date mapping.
     """
     data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    offset = 0
+    for columns, lines, problems in results:
+        for i, error in problems:
+            log.debug('Problem with line %d: %s', offset + i, error)
+        offset += lines
+        for user_id, ordinal, start, end in zip(*columns):
+            date = datetime.fromordinal(ordinal).date()
+            data.setdefault(user_id, {})[date] = {
+                'start': (datetime.min + timedelta(seconds=start)).time(),
+                'end': (datetime.min + timedelta(seconds=end)).time(),
+            }
+    return data
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+
+def start_workers():
+    """
+    Starts pool of DATA_WORKERS processes, one per CPU by default,
+    parsing byte ranges of big CSV files. It has to be started before
+    any threads: processes forked later inherit locks held by other
+    threads, e.g. of logging handlers, and may wait on them forever.
+    """
+    import multiprocessing
+    processes = app.config.get('DATA_WORKERS') or multiprocessing.cpu_count()
+    if processes > 1 and 'ranges' not in worker_pools:
+        worker_pools['ranges'] = multiprocessing.Pool(processes)
+    return worker_pools.get('ranges')
+
+
+def stop_workers():
+    """
+    Stops pool started by start_workers.
+    """
+    pool = worker_pools.pop('ranges', None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def map_ranges(tasks):
+    """
+    Parses byte ranges in pool started by start_workers when there is
+    more than one, in this process otherwise.
+    """
+    pool = worker_pools.get('ranges')
+    if pool is None or len(tasks) < 2:
+        return [parse_range(task) for task in tasks]
+    return pool.map(parse_range, tasks)
+
+
+def load_shards(paths, previous=()):
+    """
+    Parses CSV shards, reusing unchanged ones. Big files are split into
+    DATA_CHUNK_SIZE byte ranges, parsed in parallel once start_workers
+    was called. With a shared cache backend, parsed ranges are kept
+    there under file signature, so unchanged files aren't parsed again
+    after restart. Shards of previous paths which are gone are dropped.
+    """
+    signatures = dict((path, file_signature(path)) for path in paths)
+    stale = [
+        path for path in paths
+        if shard_cache.get(path, (None, None))[0] != signatures[path]
+    ]
+    backend = cache_backend()
+    keys = dict(
+        (path, ('ranges', code_signature(), path, signatures[path]))
+        for path in stale
+    )
+    chunk_size = app.config.get('DATA_CHUNK_SIZE', 32 * 1024 * 1024)
+    stored = {}
+    tasks = []
+    for path in stale:
+        if backend.shared:
+            stored[path] = backend.get(keys[path])
+        if stored.get(path) is None:
+            tasks.extend(split_ranges(path, chunk_size))
+    results = map_ranges(tasks)
+    for path in stale:
+        if stored.get(path) is not None:
+            parsed = unpack_ranges(stored[path])
+        else:
+            parsed = [
+                result for task, result in zip(tasks, results)
+                if task[0] == path
+            ]
+            if backend.shared:
+                backend.set(keys[path], pack_ranges(parsed))
+        shard_cache[path] = (signatures[path], collect_ranges(parsed))
+    for path in set(previous) - set(paths):
+        shard_cache.pop(path, None)
+        content_digests.pop(path, None)
+    return [shard_cache[path][1] for path in paths]
+
+
+def pack_ranges(results):
+    """
+    Parsed byte ranges with columns as (typecode, bytes) pairs for cache
+    backends, arrays are pickled item by item on Python 2.
+    """
+    return [
+        (
+            [(column.typecode, column.tostring()) for column in columns],
+            lines,
+            problems,
+        )
+        for columns, lines, problems in results
+    ]
+
+
+def unpack_ranges(values):
+    """
+    Parsed byte ranges from values packed by pack_ranges.
+    """
+    return [
+        (
+            tuple(array(typecode, data) for typecode, data in columns),
+            lines,
+            problems,
+        )
+        for columns, lines, problems in values
+    ]
+
+
+def merge_shards(shards):
+    """
+    Merges per-shard user_id -> date mappings, later shards win.
+    A single shard is returned as it is.
+    """
+    if len(shards) == 1:
+        return shards[0]
+    data = {}
+    for shard in shards:
+        for user_id, dates in shard.iteritems():
+            data.setdefault(user_id, {}).update(dates)
     return data
 
 
@@ -107,7 +1332,15 @@ def xml_translator():
     """
     Extracts user data from XML file.
     """
-    tree = ET.parse(app.config['XML_DATA'])
+    return get_snapshot().users
+
+
+def parse_users(path):
+    """
+    Parses user names and avatars from XML file.
+    """
+    import xml.etree.ElementTree as ET
+    tree = ET.parse(path)
     root = tree.getroot()
     root_server = root.find('server')
     protocol = root_server.find('protocol').text
@@ -124,6 +1357,7 @@ def xml_translator():
     return data
 
 
+@traced
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
@@ -179,6 +1413,7 @@ def day_start_end(items):
     return results
 
 
+@traced
 def podium_data_maker(user):
     """
     Groups presence entries as podium data.
@@ -242,6 +1477,7 @@ def user_validate(months_sum, user):
     return result
 
 
+@traced
 def group_by_month(items, year):
     """
     Groups presence entries by month.
@@ -255,6 +1491,7 @@ def group_by_month(items, year):
     return results
 
 
+@traced
 def sorted_months_dict(dict_months):
     """
     Sort months dict.
@@ -306,3 +1543,468 @@ def five_top_workers(month, year):
             pass
     sorted_dict = sorted_months_dict(dict_months)
     return five_top_user_data(dict_months, sorted_dict)
+
+
+@data_index
+def calendar_index(data):
+    """
+    Counts presence rows and users for every (year, month) with data.
+    """
+    rows = {}
+    users = {}
+    for user_id, dates in data.iteritems():
+        for date in dates:
+            key = (date.year, date.month)
+            rows[key] = rows.get(key, 0) + 1
+            users.setdefault(key, set()).add(user_id)
+    return OrderedDict(
+        (key, {'rows': rows[key], 'users': len(users[key])})
+        for key in sorted(rows)
+    )
+
+
+@data_index
+def months_listing(data):
+    """
+    Month list of every year with presence data, with counts.
+    """
+    index = calendar_index()
+    years = sorted(set(year for year, month in index))
+    empty = {'rows': 0, 'users': 0}
+    return [
+        dict(
+            index.get((year, number + 1), empty),
+            number=number,
+            name=name,
+            year=year
+        )
+        for year in years
+        for number, name in enumerate(calendar.month_abbr[1:])
+    ]
+
+
+@data_index
+def month_rankings(data):
+    """
+    Monthly totals and mean arrivals per user with sorted arrays of them.
+    It creates structure like this:
+    rankings = {
+        (2013, 9): {
+            'users': {10: (78217, 35239.5)},
+            'totals': [78217],
+            'arrivals': [35239.5],
+        }
+    }
+    """
+    months = {}
+    for user_id, dates in data.iteritems():
+        grouped = {}
+        for date, times in dates.iteritems():
+            month = grouped.setdefault((date.year, date.month), [0, []])
+            month[0] += interval(times['start'], times['end'])
+            month[1].append(seconds_since_midnight(times['start']))
+        for key, (total, starts) in grouped.iteritems():
+            months.setdefault(key, {})[user_id] = (total, mean(starts))
+    rankings = {}
+    for key, users in months.iteritems():
+        rankings[key] = {
+            'users': users,
+            'totals': sorted(total for total, _ in users.itervalues()),
+            'arrivals': sorted(arrival for _, arrival in users.itervalues()),
+        }
+    return rankings
+
+
+def rank_position(values, value, descending=False):
+    """
+    Rank (1 is best) and percentile of value in sorted values.
+    Percentile tells how many values are worse or equal.
+    """
+    if descending:
+        rank = len(values) - bisect.bisect_right(values, value) + 1
+        worse = bisect.bisect_right(values, value)
+    else:
+        rank = bisect.bisect_left(values, value) + 1
+        worse = len(values) - bisect.bisect_left(values, value)
+    return {
+        'rank': rank,
+        'percentile': 100.0 * worse / len(values),
+    }
+
+
+def user_rank(user_id, year, month):
+    """
+    Rank of user among colleagues by monthly hours and mean arrival.
+    """
+    ranking = month_rankings().get((year, month))
+    if ranking is None or user_id not in ranking['users']:
+        return None
+    total, arrival = ranking['users'][user_id]
+    hours = rank_position(ranking['totals'], total, descending=True)
+    hours['value'] = total / 3600.0
+    arrivals = rank_position(ranking['arrivals'], arrival)
+    arrivals['value'] = arrival
+    return {
+        'year': year,
+        'month': month,
+        'users': len(ranking['users']),
+        'hours': hours,
+        'arrival': arrivals,
+    }
+
+
+@data_index
+def presence_columns(data):
+    """
+    Presence data as numpy arrays of users, date ordinals, start and end
+    seconds, sorted by user and date.
+    """
+    import numpy
+    rows = sorted(
+        (
+            user_id,
+            date.toordinal(),
+            seconds_since_midnight(times['start']),
+            seconds_since_midnight(times['end']),
+        )
+        for user_id, dates in data.iteritems()
+        for date, times in dates.iteritems()
+    )
+    table = numpy.array(rows, dtype=numpy.int64).reshape(-1, 4)
+    return {
+        'users': table[:, 0],
+        'dates': table[:, 1],
+        'starts': table[:, 2],
+        'ends': table[:, 3],
+    }
+
+
+def iso_weeks(ordinals):
+    """
+    ISO years and week numbers of date ordinals array.
+    """
+    import numpy
+    epoch = datetime(1970, 1, 1).toordinal()
+    thursdays = ordinals - (ordinals - 1) % 7 + 3
+    years = (
+        (thursdays - epoch).astype('datetime64[D]').astype('datetime64[Y]')
+    )
+    first_days = years.astype('datetime64[D]').astype(numpy.int64) + epoch
+    weeks = (thursdays - first_days) // 7 + 1
+    return years.astype(numpy.int64) + 1970, weeks
+
+
+@data_index
+def weekly_rollup(data):  # pylint: disable=unused-argument
+    """
+    Presence seconds and days per user and ISO week, and per ISO week
+    for the whole team, as numpy arrays sorted by user, year and week.
+    """
+    import numpy
+    columns = presence_columns()
+    years, weeks = iso_weeks(columns['dates'])
+    seconds = columns['ends'] - columns['starts']
+    keys, index = numpy.unique(
+        (columns['users'] * 10000 + years) * 100 + weeks,
+        return_inverse=True
+    )
+    team_keys, team_index = numpy.unique(
+        years * 100 + weeks, return_inverse=True
+    )
+    return {
+        'users': keys // 1000000,
+        'years': keys // 100 % 10000,
+        'weeks': keys % 100,
+        'seconds': numpy.bincount(index, weights=seconds, minlength=len(keys)),
+        'days': numpy.bincount(index, minlength=len(keys)),
+        'team_years': team_keys // 100,
+        'team_weeks': team_keys % 100,
+        'team_seconds': numpy.bincount(
+            team_index, weights=seconds, minlength=len(team_keys)
+        ),
+        'team_users': numpy.bincount(
+            team_index[numpy.unique(index, return_index=True)[1]],
+            minlength=len(team_keys)
+        ),
+    }
+
+
+def user_weeks(user_id):
+    """
+    Presence hours and days of user per ISO week.
+    """
+    import numpy
+    rollup = weekly_rollup()
+    first, last = numpy.searchsorted(rollup['users'], [user_id, user_id + 1])
+    return [
+        {
+            'year': int(rollup['years'][row]),
+            'week': int(rollup['weeks'][row]),
+            'hours': rollup['seconds'][row] / 3600.0,
+            'days': int(rollup['days'][row]),
+        }
+        for row in xrange(first, last)
+    ]
+
+
+def user_overtime(user_id, threshold):
+    """
+    Weeks in which user worked more than threshold hours.
+    """
+    weeks = []
+    for week in user_weeks(user_id):
+        if week['hours'] > threshold:
+            week['overtime'] = week['hours'] - threshold
+            weeks.append(week)
+    return weeks
+
+
+def team_weeks():
+    """
+    Presence hours and number of present users per ISO week.
+    """
+    rollup = weekly_rollup()
+    return [
+        {
+            'year': int(year),
+            'week': int(week),
+            'hours': seconds / 3600.0,
+            'users': int(users),
+        }
+        for year, week, seconds, users in zip(
+            rollup['team_years'],
+            rollup['team_weeks'],
+            rollup['team_seconds'],
+            rollup['team_users']
+        )
+    ]
+
+
+CUBE_AXES = ('user', 'year', 'month', 'weekday')
+CUBE_MEASURES = ('seconds', 'days', 'starts', 'ends')
+
+
+@data_index
+def presence_cube(data):  # pylint: disable=unused-argument
+    """
+    Dense tensor of presence measures summed per user, year, month
+    and weekday, with labels of every axis.
+    It creates structure like this:
+    cube = {
+        'labels': {'user': [10, 11], 'year': [2013], 'month': [1, ..., 12],
+                   'weekday': [0, ..., 6]},
+        'tensor': array of shape (measures, users, years, 12, 7),
+    }
+    Measures are ordered like CUBE_MEASURES.
+    """
+    import numpy
+    columns = presence_columns()
+    epoch = datetime(1970, 1, 1).toordinal()
+    months = (columns['dates'] - epoch).astype('datetime64[D]').astype(
+        'datetime64[M]'
+    ).astype(numpy.int64)
+    labels = {
+        'user': numpy.unique(columns['users']),
+        'year': numpy.unique(months // 12 + 1970),
+        'month': numpy.arange(1, 13),
+        'weekday': numpy.arange(7),
+    }
+    shape = tuple(len(labels[axis]) for axis in CUBE_AXES)
+    cells = numpy.ravel_multi_index(
+        (
+            numpy.searchsorted(labels['user'], columns['users']),
+            numpy.searchsorted(labels['year'], months // 12 + 1970),
+            months % 12,
+            (columns['dates'] - 1) % 7,
+        ),
+        shape
+    )
+    size = int(numpy.prod(shape))
+    measures = (
+        columns['ends'] - columns['starts'],
+        numpy.ones(len(cells)),
+        columns['starts'],
+        columns['ends'],
+    )
+    tensor = numpy.array([
+        numpy.bincount(cells, weights=weights, minlength=size)
+        for weights in measures
+    ]).reshape((len(CUBE_MEASURES),) + shape)
+    return {'labels': labels, 'tensor': tensor}
+
+
+def cube_query(group_by=(), filters=None):
+    """
+    Presence measures of cube summed over axes not in group_by, limited
+    to axis labels in filters, e.g. filters={'year': [2013]}.
+    Returns one row per non-empty group.
+    """
+    import numpy
+    cube = presence_cube()
+    tensor = cube['tensor']
+    labels = dict(cube['labels'])
+    for axis, values in (filters or {}).iteritems():
+        position = CUBE_AXES.index(axis) + 1
+        selected = numpy.isin(labels[axis], values)
+        tensor = tensor.compress(selected, axis=position)
+        labels[axis] = labels[axis][selected]
+    tensor = tensor.sum(
+        axis=tuple(
+            position + 1
+            for position, axis in enumerate(CUBE_AXES)
+            if axis not in group_by
+        ),
+        keepdims=True
+    )
+    rows = []
+    for cell in zip(*numpy.nonzero(tensor[1])):
+        row = dict(
+            (axis, int(labels[axis][position]))
+            for axis, position in zip(CUBE_AXES, cell)
+            if axis in group_by
+        )
+        for measure, values in zip(CUBE_MEASURES, tensor):
+            row[measure] = int(values[cell])
+        rows.append(row)
+    return rows
+
+
+@data_index
+def attendance_bitsets(data):
+    """
+    Days of presence of every user as one int bitset per year, bit n set
+    when user was present on day n + 1 of the year, and range of rows
+    of every user in presence_columns.
+    It creates structure like this:
+    index = {
+        'bitsets': {10: {2013: 0b111 << 252}},
+        'rows': {10: (0, 3)},
+    }
+    """
+    import numpy
+    bitsets = {}
+    for user_id, dates in data.iteritems():
+        years = bitsets[user_id] = {}
+        for date in dates:
+            years[date.year] = years.get(date.year, 0) | (
+                1 << date.timetuple().tm_yday - 1
+            )
+    users = presence_columns()['users']
+    user_ids = numpy.unique(users)
+    firsts = numpy.searchsorted(users, user_ids)
+    lasts = numpy.searchsorted(users, user_ids + 1)
+    return {
+        'bitsets': bitsets,
+        'rows': dict(
+            (int(user_id), (int(first), int(last)))
+            for user_id, first, last in zip(user_ids, firsts, lasts)
+        ),
+    }
+
+
+def year_mask(year, first=None, last=None):
+    """
+    Bitset of days of year between first and last date, inclusive.
+    """
+    low = 0
+    high = 366 if calendar.isleap(year) else 365
+    if first is not None and first.year >= year:
+        low = high if first.year > year else first.timetuple().tm_yday - 1
+    if last is not None and last.year <= year:
+        high = 0 if last.year < year else last.timetuple().tm_yday
+    if high <= low:
+        return 0
+    return (1 << high) - (1 << low)
+
+
+def copresence(user_ids, first=None, last=None):
+    """
+    Days between first and last date, inclusive, on which all given users
+    were present, with the interval they were all in and its length.
+    Days are intersected as bitsets, intervals as numpy arrays.
+    Returns [{'date': '2013-09-10', 'start': 34745, 'end': 50154,
+    'overlap': 15409}, ...] sorted by date.
+    """
+    import numpy
+    index = attendance_bitsets()
+    bitsets = index['bitsets']
+    user_ids = sorted(set(user_ids))
+    if not user_ids or any(user_id not in bitsets for user_id in user_ids):
+        return []
+    ordinals = []
+    years = set.intersection(*(set(bitsets[user_id]) for user_id in user_ids))
+    for year in sorted(years):
+        common = year_mask(year, first, last)
+        for user_id in user_ids:
+            if not common:
+                break
+            common &= bitsets[user_id][year]
+        base = datetime(year, 1, 1).toordinal()
+        while common:
+            lowest = common & -common
+            ordinals.append(base + lowest.bit_length() - 1)
+            common ^= lowest
+    columns = presence_columns()
+    ordinals = numpy.array(ordinals, dtype=numpy.int64)
+    starts = numpy.zeros(len(ordinals), dtype=numpy.int64)
+    ends = numpy.full(len(ordinals), 24 * 3600, dtype=numpy.int64)
+    for user_id in user_ids:
+        first_row, last_row = index['rows'][user_id]
+        rows = first_row + numpy.searchsorted(
+            columns['dates'][first_row:last_row], ordinals
+        )
+        starts = numpy.maximum(starts, columns['starts'][rows])
+        ends = numpy.minimum(ends, columns['ends'][rows])
+    return [
+        {
+            'date': datetime.fromordinal(ordinal).date().isoformat(),
+            'start': start,
+            'end': end,
+            'overlap': max(end - start, 0),
+        }
+        for ordinal, start, end in zip(
+            ordinals.tolist(), starts.tolist(), ends.tolist()
+        )
+    ]
+
+
+@data_index
+def users_index(data):
+    """
+    Users sorted by lowercase name for prefix search.
+    It creates structure like this:
+    index = {
+        'keys': [(u'adam p.', 141), (u'adrian k.', 176)],
+        'present': set([141]),
+    }
+    """
+    users = xml_translator()
+    return {
+        'keys': sorted(
+            (unicode(users[user_id]['name']).lower(), user_id)
+            for user_id in users
+        ),
+        'present': set(data),
+    }
+
+
+def search_users(prefix='', cursor=0, limit=None, present=False):
+    """
+    Users sorted by name starting with prefix, from cursor position.
+    Returns user ids and cursor of next page, None on the last page.
+    """
+    index = users_index()
+    keys = index['keys']
+    position = max(
+        cursor, bisect.bisect_left(keys, (unicode(prefix).lower(),))
+    )
+    found = []
+    while position < len(keys) and keys[position][0].startswith(
+            unicode(prefix).lower()):
+        if limit is not None and len(found) == limit:
+            return found, position
+        user_id = keys[position][1]
+        if not present or user_id in index['present']:
+            found.append(user_id)
+        position += 1
+    return found, None
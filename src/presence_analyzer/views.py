@@ -3,25 +3,154 @@
 Defines views.
 """
 import calendar
+import json
 import logging
+import mimetypes
+import os
+import resource
+import threading
+from datetime import datetime
+from functools import wraps
 
-# pylint: disable=import-error
-from flask_mako import MakoTemplates, render_template
+from flask import Response, abort, g, request, send_from_directory
 
+from presence_analyzer.helpers import static_build_dir
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
+    CUBE_AXES,
+    admission,
+    allocations,
+    cached_response,
+    changes_since,
+    coalesce,
+    copresence,
+    cube_query,
     day_start_end,
+    finish_trace,
     five_top_workers,
     get_data,
+    get_snapshot,
     group_by_weekday,
     jsonify,
     mean,
+    memory_report,
+    months_listing,
+    object_size,
     podium_data_maker,
+    search_users,
+    start_trace,
+    team_weeks,
+    user_overtime,
+    user_rank,
+    user_weeks,
     xml_translator
 )
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-mako = MakoTemplates(app)  # pylint: disable=invalid-name
+SLOW_LOG = logging.getLogger('presence_analyzer.slow')
+mako = None  # pylint: disable=invalid-name
+mako_lock = threading.Lock()  # pylint: disable=invalid-name
+PAGES = frozenset(
+    page
+    for page in os.listdir(os.path.join(app.root_path, app.template_folder))
+    if page.endswith('.html') and page not in ('base.html', 'not_found.html')
+)
+page_cache = {}  # pylint: disable=invalid-name
+USER_FIELDS = ('user_id', 'name', 'avatar')
+ALLOCATION_ACTIONS = ('start', 'snapshot', 'diff', 'stop', 'status')
+
+
+def api_route(rule, **options):
+    """
+    Registers API view both for default and for named datasets.
+    """
+    def decorator(function):
+        """
+        Adds both URL rules to the view.
+        """
+        app.route('/api/v1' + rule, **options)(function)
+        app.route('/api/v1/<dataset>' + rule, **options)(function)
+        return function
+    return decorator
+
+
+@app.url_value_preprocessor
+def pick_dataset(endpoint, values):  # pylint: disable=unused-argument
+    """
+    Selects dataset named in URL for the request.
+    """
+    if values and 'dataset' in values:
+        g.dataset = values.pop('dataset')
+        if g.dataset not in app.config.get('DATASETS', {}):
+            abort(404)
+
+
+@app.before_request
+def trace_request():
+    """
+    Traces spans of request when SLOW_REQUEST_SECONDS is set.
+    """
+    if app.config.get('SLOW_REQUEST_SECONDS') is not None:
+        start_trace()
+
+
+@app.teardown_request
+def log_slow_request(exception=None):  # pylint: disable=unused-argument
+    """
+    Logs request slower than SLOW_REQUEST_SECONDS as JSON line with
+    its arguments and seconds spent in every span.
+    """
+    trace = finish_trace()
+    if trace is None:
+        return
+    seconds, spans = trace
+    if seconds < app.config.get('SLOW_REQUEST_SECONDS', 0):
+        return
+    SLOW_LOG.warning(json.dumps(
+        {
+            'method': request.method,
+            'path': request.path,
+            'args': request.args.to_dict(flat=False),
+            'view_args': request.view_args,
+            'seconds': seconds,
+            'spans': spans,
+        },
+        sort_keys=True
+    ))
+
+
+def mako_templates():
+    """
+    Mako templates extension, Mako is imported on first rendered page.
+    """
+    global mako  # pylint: disable=global-statement, invalid-name
+    with mako_lock:
+        if mako is None:
+            # pylint: disable=import-error
+            from flask_mako import MakoTemplates
+            mako = MakoTemplates(app)
+    return mako
+
+
+def render_page(page):
+    """
+    Renders page once per deploy, the output depends only on url_for.
+    """
+    key = (page, request.script_root)
+    if app.debug or key not in page_cache:
+        # pylint: disable=import-error
+        from flask_mako import render_template
+        page_cache[key] = render_template(page, name=mako_templates())
+    return page_cache[key]
+
+
+def compile_pages():
+    """
+    Compiles and renders all registered pages ahead of first request.
+    """
+    with app.test_request_context():
+        for page in sorted(PAGES) + ['not_found.html']:
+            render_page(page)
 
 
 @app.route('/', defaults={'where': 'presence_weekday.html'})
@@ -30,54 +159,101 @@ def redirect_mako(where):
     """
     Redirects to pages.
     """
-    try:
-        return render_template(where, name=mako)
-    except Exception:  # pylint: disable=broad-except
-        return render_template('not_found.html', name=mako)
+    if where not in PAGES:
+        return render_page('not_found.html'), 404
+    return render_page(where)
 
 
-@app.route('/api/v1/users', methods=['GET'])
+@app.route('/assets/<path:filename>')
+def static_asset(filename):
+    """
+    Serves fingerprinted static files, gzipped when client accepts it.
+    """
+    directory = static_build_dir()
+    compressed = os.path.join(directory, filename + '.gz')
+    if 'gzip' in request.accept_encodings and os.path.isfile(compressed):
+        response = send_from_directory(
+            directory,
+            filename + '.gz',
+            mimetype=mimetypes.guess_type(filename)[0]
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(directory, filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.headers['Cache-Control'] += ', immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@api_route('/users', methods=['GET'])
+@cached_response('q', 'limit', 'cursor', 'has_data', 'fields')
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
+    With any of ?q=, ?limit=, ?cursor= or ?has_data=1 users are sorted
+    by name, filtered by name prefix or presence data and paginated;
+    the next page cursor is sent in X-Next-Cursor header.
+    ?limit= is capped at USERS_PAGE_LIMIT.
+    ?fields=user_id,name limits fields of every user.
+    Limit below 1 and unknown fields abort request with 400.
     """
     data = xml_translator()
-    return [
-        {'user_id': i, 'name': data[i]['name'], 'avatar': data[i]['avatar']}
-        for i in data.keys()
+    fields = USER_FIELDS
+    if request.args.get('fields'):
+        fields = request.args['fields'].split(',')
+        if any(field not in USER_FIELDS for field in fields):
+            abort(400)
+    limit = None
+    if 'limit' in request.args:
+        limit = request.args.get('limit', 0, type=int)
+        if limit < 1:
+            abort(400)
+        limit = min(limit, app.config.get('USERS_PAGE_LIMIT', 1000))
+    paginated = any(
+        key in request.args for key in ('q', 'limit', 'cursor', 'has_data')
+    )
+    if not paginated:
+        users, cursor = data.keys(), None
+    else:
+        users, cursor = search_users(
+            prefix=request.args.get('q', ''),
+            cursor=request.args.get('cursor', 0, type=int),
+            limit=limit,
+            present=bool(request.args.get('has_data', 0, type=int))
+        )
+    result = [
+        dict(
+            (field, i if field == 'user_id' else data[i][field])
+            for field in fields
+        )
+        for i in users
     ]
+    if cursor is None:
+        return result
+    return result, {'X-Next-Cursor': str(cursor)}
 
 
-@app.route('/api/v1/months', methods=['GET'])
+@api_route('/months', methods=['GET'])
+@cached_response('counts')
 @jsonify
 def months_view():
     """
-    Month list for dropdown.
+    Month list for dropdown, with row and user counts on ?counts=1.
     """
-    data = get_data()
-    years = []
-    years_on = []
-    for user in data:
-        year = data[user].items()[0][0].year
-        if year in years_on:
-            pass
-        else:
-            years.append(('year', year))
-            years_on.append(year)
-    years = sorted(years, key=lambda year: year[1])
-    months = []
-    for month in list(enumerate(calendar.month_abbr[1:])):
-        months.append({'number': month[0], 'name': month[1]})
-    result = []
-    for year in years:
-        for month in months:
-            data = dict(month.items() + [year])
-            result.append(data)
-    return result
+    months = months_listing()
+    if request.args.get('counts', 0, type=int):
+        return months
+    return [
+        dict((key, month[key]) for key in ('number', 'name', 'year'))
+        for month in months
+    ]
 
 
-@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@api_route('/mean_time_weekday/<int:user_id>', methods=['GET'])
+@cached_response()
 @jsonify
 def mean_time_weekday_view(user_id):
     """
@@ -95,7 +271,8 @@ def mean_time_weekday_view(user_id):
     return result
 
 
-@app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@api_route('/presence_weekday/<int:user_id>', methods=['GET'])
+@cached_response()
 @jsonify
 def presence_weekday_view(user_id):
     """
@@ -115,7 +292,8 @@ def presence_weekday_view(user_id):
     return result
 
 
-@app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@api_route('/presence_start_end/<int:user_id>', methods=['GET'])
+@cached_response()
 @jsonify
 def presence_start_end(user_id):
     """
@@ -128,7 +306,8 @@ def presence_start_end(user_id):
     return day_start_end(data[user_id])
 
 
-@app.route('/api/v1/podium/<int:user_id>', methods=['GET'])
+@api_route('/podium/<int:user_id>', methods=['GET'])
+@cached_response()
 @jsonify
 def podium(user_id):
     """
@@ -141,11 +320,215 @@ def podium(user_id):
     return podium_data_maker(data[user_id])
 
 
-@app.route('/api/v1/five_top/<month_year>', methods=['GET'])
+@api_route('/five_top/<month_year>', methods=['GET'])
+@cached_response()
 @jsonify
+@coalesce
+@admission(limit=4, queue=16)
 def five_top(month_year):
     """
     Top 5 workers per months in year.
     """
     data = month_year.split(',')
     return five_top_workers(int(data[0]), int(data[1]))
+
+
+@api_route('/rank/<int:user_id>/<int:year>/<int:month>', methods=['GET'])
+@cached_response()
+@jsonify
+def rank_view(user_id, year, month):
+    """
+    User rank and percentile among colleagues in given month.
+    """
+    result = user_rank(user_id, year, month)
+    if result is None:
+        return 'no data'
+    return result
+
+
+@api_route('/weekly/<int:user_id>', methods=['GET'])
+@cached_response()
+@jsonify
+def weekly_view(user_id):
+    """
+    Presence hours of given user per ISO week.
+    """
+    if user_id not in get_data():
+        return 'no data'
+
+    return user_weeks(user_id)
+
+
+@api_route('/overtime/<int:user_id>', methods=['GET'])
+@cached_response('threshold')
+@jsonify
+def overtime_view(user_id):
+    """
+    Weeks of given user above ?threshold= hours, WEEKLY_HOURS by default.
+    """
+    if user_id not in get_data():
+        return 'no data'
+
+    threshold = request.args.get(
+        'threshold', app.config.get('WEEKLY_HOURS', 40), type=float
+    )
+    weeks = user_overtime(user_id, threshold)
+    return {
+        'threshold': threshold,
+        'overtime': sum(week['overtime'] for week in weeks),
+        'weeks': weeks,
+    }
+
+
+@api_route('/weekly_team', methods=['GET'])
+@cached_response()
+@jsonify
+def weekly_team_view():
+    """
+    Team presence hours per ISO week.
+    """
+    return team_weeks()
+
+
+@api_route('/cube', methods=['GET'])
+@jsonify
+def cube_view():
+    """
+    Presence seconds, days and start and end second sums grouped by axes
+    in ?group_by=year,month and filtered by axis labels, e.g. ?user=10,11
+    or ?weekday=0. Axes are user, year, month and weekday.
+    Malformed labels abort request with 400.
+    """
+    group_by = request.args.get('group_by', '').split(',')
+    filters = {}
+    for axis in CUBE_AXES:
+        if request.args.get(axis):
+            try:
+                filters[axis] = [
+                    int(value) for value in request.args[axis].split(',')
+                ]
+            except ValueError:
+                abort(400)
+    return cube_query(
+        [axis for axis in group_by if axis in CUBE_AXES], filters
+    )
+
+
+def date_arg(name):
+    """
+    Date given as YYYY-MM-DD in query argument, None when it is missing.
+    Malformed date aborts request with 400.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+@api_route('/copresence', methods=['GET'])
+@cached_response('users', 'from', 'to')
+@jsonify
+def copresence_view():
+    """
+    Days on which all users in ?users=10,11 were present, limited
+    to ?from= and ?to= dates given as YYYY-MM-DD, with seconds their
+    hours overlapped on every day and in total.
+    """
+    users = [
+        int(value) for value in request.args.get('users', '').split(',')
+        if value.strip().isdigit()
+    ]
+    days = copresence(
+        users,
+        date_arg('from'),
+        date_arg('to')
+    )
+    return {
+        'users': users,
+        'days': days,
+        'overlap': sum(day['overlap'] for day in days),
+    }
+
+
+@api_route('/changes', methods=['GET'])
+@jsonify
+def changes_view():
+    """
+    Presence rows changed since data version given in ?since= of epoch
+    given in ?epoch=. Versions of other epochs, e.g. from before restart,
+    need resync.
+    """
+    snapshot = get_snapshot()
+    result = {'version': snapshot.version, 'epoch': snapshot.epoch}
+    changes = changes_since(
+        request.args.get('since', type=int), request.args.get('epoch')
+    )
+    if changes is None:
+        result['resync'] = True
+    else:
+        result['changes'] = changes
+    return result
+
+
+def admin_only(function):
+    """
+    Serves wrapped view only when ADMIN_ENDPOINTS is set.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        if not app.config.get('ADMIN_ENDPOINTS'):
+            abort(404)
+        return function(*args, **kwargs)
+    return inner
+
+
+@app.route('/api/v1/admin/memory', methods=['GET'])
+@admin_only
+@jsonify
+def memory_view():
+    """
+    Approximate memory taken by datasets, indexes, caches and pages.
+    """
+    report = memory_report()
+    report['caches']['pages'] = sorted(
+        (
+            {'page': page, 'size': object_size(html)}
+            for (page, _), html in page_cache.items()
+        ),
+        key=lambda entry: entry['size'],
+        reverse=True
+    )
+    report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+@app.route('/api/v1/admin/tracemalloc/<action>', methods=['GET', 'POST'])
+@admin_only
+@jsonify
+def tracemalloc_view(action):
+    """
+    Starts, stops, snapshots or diffs allocation traces, see allocations.
+    ?limit= caps listed source lines, ?frames= sets traceback depth.
+    """
+    if action not in ALLOCATION_ACTIONS:
+        abort(404)
+    report = allocations(
+        action,
+        request.args.get('limit', 20, type=int),
+        request.args.get('frames', 1, type=int)
+    )
+    if report is None:
+        abort(
+            Response(
+                json.dumps('tracemalloc is not available'),
+                status=501,
+                mimetype='application/json'
+            )
+        )
+    return report